@@ -41,3 +41,17 @@ register(EXPORT,
     extension = "ged",
 )
 
+register(EXPORT,
+    id    = 'Export GEDCOM delta for Geneanet',
+    name  = _("Export GEDCOM delta for Geneanet "),
+    name_accell  = _("GEDCOM delta for Geneanet "),
+    description =  _("Records changed since the previous delta export, in the GEDCOM format for Geneanet."),
+    version = '1.7.1',
+    gramps_target_version = '5.1',
+    status = STABLE, 
+    fname = 'GedcomforGeneanet.py',
+    export_function = 'export_delta',
+    export_options = 'GedcomWriterOptionBox',
+    export_options_title = _('GEDCOM for Geneanet options'),
+    extension = "ged",
+)
@@ -32,34 +32,52 @@ Extends GedcomWriter to include common non-compliant GEDCOM additions.
 import os
 import time
 import io
+import hashlib
+import itertools
+import pickle
+import weakref
+from concurrent.futures import ThreadPoolExecutor
 
 #------------------------------------------------------------------------
 #
 # GTK modules
 #
 #------------------------------------------------------------------------
-from gi.repository import Gtk
+from gi.repository import GLib, Gtk
 
 import gramps.plugins.lib.libgedcom as libgedcom
 from gramps.plugins.export import exportgedcom
 from gramps.gui.plug.export import WriterOptionBox
-from gramps.gen.errors import DatabaseError
+from gramps.gen.errors import DatabaseError, HandleError
+from gramps.gen.proxy.proxybase import ProxyDbBase
+from gramps.gen.proxy.referencedbyselection import \
+    ReferencedBySelectionProxyDb
 from gramps.gen.lib import (EventRoleType, FamilyRelType, Citation, EventType,\
- PlaceType,Person, AttributeType, NameType, NoteType)
-from gramps.gen.const import GRAMPS_LOCALE as glocale
+ PlaceType,Person, AttributeType, NameType, NoteType, UrlType)
+from gramps.gen.const import GRAMPS_LOCALE as glocale, USER_PLUGINS
 from gramps.gen.utils.file import media_path_full, media_path, relative_path
 try:
     _trans = glocale.get_addon_translator(__file__)
 except ValueError:
     _trans = glocale.translation
 _ = _trans.gettext
-import zipfile
+ngettext = _trans.ngettext
 import logging
 from gramps.version import VERSION
 from gramps.gen.config import config
 from gramps.gen.display.place import displayer as _pd
 from gramps.gen.utils.location import get_main_location
 from gramps.gen.utils.place import conv_lat_lon
+from libgeneanet import (ExportCache, FilterCache, GedcomEmitter, LRUCache,
+                         MediaArchive, MediaQueue, RecordCache, breakup,
+                         load_manifest, natural_key, parse_compression_policy,
+                         referenced_ids, replace_if_changed, save_manifest,
+                         split_lines)
+from libgeneanetdb import (BULK_LIVING_SUPPORTED, BulkLivingProxyDb,
+                           CachedFilterProxyDb, KinshipIndex, MaterializedDb,
+                           SteppedReferencedProxyDb, content_stamp,
+                           filter_sets, last_change, raw_gramps_ids,
+                           references_to, shared_events)
 
 LOG = logging.getLogger("gedcomforgeneanet")
 
@@ -91,6 +109,14 @@ QUALITY_MAP = {
     Citation.CONF_VERY_LOW  : "0",
 }
 
+WITNESS_ROLES = (EventRoleType.WITNESS, EventRoleType.CELEBRANT,
+                 EventRoleType.INFORMANT, EventRoleType.CLERGY,
+                 EventRoleType.AIDE, EventRoleType.CUSTOM)
+
+# Bump when the rendering of the records changes, to drop the records
+# cached by the previous versions.
+RECORD_CACHE_VERSION = 2
+
 GRAMPLET_CONFIG_NAME = "gedcomforgeneanet"
 CONFIG = config.register_manager("gedcomforgeneanet")
 
@@ -101,33 +127,176 @@ CONFIG.register("preferences.extended_role" , False)
 CONFIG.register("preferences.relativepath" , True)
 CONFIG.register("preferences.quaynote", True)
 CONFIG.register("preferences.zip", False)
+CONFIG.register("preferences.zip_dedupe", False)
+CONFIG.register("preferences.zip_incremental", False)
 CONFIG.register("preferences.nameus" , False)
 CONFIG.register("preferences.anychar", True)
 CONFIG.register("preferences.citattr", True)
 CONFIG.register("preferences.placenote", True)
+CONFIG.register("preferences.stat_threads", 16)
+CONFIG.register("preferences.zip_threads", 0)
+CONFIG.register("preferences.zip_level", 0)
+CONFIG.register("preferences.zip_policy", "")
+CONFIG.register("preferences.zip_verify", False)
+CONFIG.register("preferences.record_cache", False)
+CONFIG.register("preferences.record_cache_size", 256)
+CONFIG.register("preferences.deterministic", False)
+CONFIG.register("preferences.record_index", False)
+CONFIG.register("preferences.filter_cache", False)
+CONFIG.register("preferences.object_cache_size", 0)
+CONFIG.register("preferences.prefetch", "")
+CONFIG.register("preferences.materialize", False)
+CONFIG.register("preferences.experimental_bulk_living", False)
+CONFIG.register("preferences.natural_order", False)
+CONFIG.register("preferences.branch_roots", "")
+CONFIG.register("preferences.branch_direction", "both")
+CONFIG.register("preferences.branch_generations", 0)
+CONFIG.register("preferences.export_time", 0)
 CONFIG.load()
 
 #-------------------------------------------------------------------------
 #
-# sort_handles_by_id
+# Records rendered aside
+#
+#-------------------------------------------------------------------------
+# Getter and writer method of each kind of cached record
+RECORD_GETTERS = {
+    "person"     : "get_person_from_handle",
+    "family"     : "get_family_from_handle",
+    "source"     : "get_source_from_handle",
+    "repository" : "get_repository_from_handle",
+    "note"       : "get_note_from_handle",
+    }
+RECORD_WRITERS = {
+    "person"     : "_person",
+    "family"     : "_family",
+    "source"     : "_source_record",
+    "repository" : "_repo_record",
+    "note"       : "_note_record",
+    }
+# Objects referring to media, and the iterators of their handles
+MEDIA_REFERRERS = {
+    "Person"   : "iter_person_handles",
+    "Family"   : "iter_family_handles",
+    "Event"    : "iter_event_handles",
+    "Place"    : "iter_place_handles",
+    "Source"   : "iter_source_handles",
+    "Citation" : "iter_citation_handles",
+    }
+RECORD_HANDLES = {
+    "person"     : "get_person_handles",
+    "family"     : "get_family_handles",
+    "source"     : "get_source_handles",
+    "repository" : "get_repository_handles",
+    "note"       : "get_note_handles",
+    }
+
+# Records of a delta export, in the order of a full export
+DELTA_KINDS = ("person", "family", "source", "repository", "note")
+
+# Accessors of the objects by handle, wrapped by DependencyRecorder and
+# CachedDb
+HANDLE_GETTERS = ("get_person_from_handle", "get_family_from_handle",
+                  "get_event_from_handle", "get_place_from_handle",
+                  "get_source_from_handle", "get_citation_from_handle",
+                  "get_repository_from_handle", "get_media_from_handle",
+                  "get_note_from_handle")
+
+# Iterator over all the objects of each type, for the prefetch
+PREFETCH_ITERATORS = {
+    "person"     : "iter_people",
+    "family"     : "iter_families",
+    "event"      : "iter_events",
+    "place"      : "iter_places",
+    "source"     : "iter_sources",
+    "citation"   : "iter_citations",
+    "repository" : "iter_repositories",
+    "media"      : "iter_media",
+    "note"       : "iter_notes",
+    }
+
+#-------------------------------------------------------------------------
+#
+# DependencyRecorder
 #
 #-------------------------------------------------------------------------
-def sort_handles_by_id(handle_list, handle_to_object):
+class DependencyRecorder(object):
     """
-    Sort a list of handles by the Gramps ID.
-    
-    The function that returns the object from the handle needs to be supplied
-    so that we get the right object.
-    
+    Database wrapper recording the handles of the objects read through it,
+    i.e. the objects a rendered record depends on.
+    """
+    def __init__(self, dbase):
+        self.dbase = dbase
+        self.keys = set()
+
+    def __getattr__(self, name):
+        return getattr(self.dbase, name)
+
+def _recording(method):
+    # keys are "<type>:<handle>", e.g. "person:..."
+    prefix = method[len("get_"):-len("_from_handle")] + ":"
+    def get_from_handle(self, handle):
+        self.keys.add(prefix + handle)
+        return getattr(self.dbase, method)(handle)
+    get_from_handle.__name__ = method
+    return get_from_handle
+
+for _method in HANDLE_GETTERS:
+    setattr(DependencyRecorder, _method, _recording(_method))
+
+#-------------------------------------------------------------------------
+#
+# CachedDb
+#
+#-------------------------------------------------------------------------
+class CachedDb(object):
     """
-    sorted_list = []
-    for handle in handle_list:
-        obj = handle_to_object(handle)
-        if obj:
-            data = (obj.get_gramps_id(), handle)
-            sorted_list.append(data)
-    sorted_list.sort()
-    return sorted_list
+    Database wrapper keeping the objects read by handle, in one LRU cache
+    of at most size objects per object type, for the duration of one
+    export. With a size of 0, only the prefetched types are cached.
+
+    size counts entries: the memory used depends on the objects, up to
+    nine times size of them being kept.
+    """
+    def __init__(self, dbase, size):
+        self.dbase = dbase
+        self.caches = {}
+        if size:
+            for method in HANDLE_GETTERS:
+                self.caches[method] = LRUCache(
+                    method[4:-12] + " objects", size)
+
+    def __getattr__(self, name):
+        return getattr(self.dbase, name)
+
+    def prefetch(self, kind):
+        """
+        Read all the objects of a type in one sequential scan, and keep
+        them all for the rest of the export. Return their number.
+        """
+        method = "get_%s_from_handle" % kind
+        cache = LRUCache(kind + " objects (prefetched)", 0)
+        for obj in getattr(self.dbase, PREFETCH_ITERATORS[kind])():
+            cache.set(obj.get_handle(), obj)
+        self.caches[method] = cache
+        return len(cache.data)
+
+def _cached(method):
+    def get_from_handle(self, handle):
+        cache = self.caches.get(method)
+        if cache is None:
+            return getattr(self.dbase, method)(handle)
+        obj = cache.get(handle)
+        if obj is None:
+            obj = getattr(self.dbase, method)(handle)
+            if obj is not None:
+                cache.set(handle, obj)
+        return obj
+    get_from_handle.__name__ = method
+    return get_from_handle
+
+for _method in HANDLE_GETTERS:
+    setattr(CachedDb, _method, _cached(_method))
 
 
 class GedcomWriterforGeneanet(exportgedcom.GedcomWriter):
@@ -147,10 +316,18 @@ class GedcomWriterforGeneanet(exportgedcom.GedcomWriter):
             self.extended_role = option_box.extended_role
             self.quaynote = option_box.quaynote
             self.zip = option_box.zip
+            self.zip_dedupe = option_box.zip_dedupe
+            self.zip_incremental = option_box.zip_incremental
+            self.use_record_cache = option_box.use_record_cache
+            self.deterministic = option_box.deterministic
+            self.record_index = option_box.record_index
             self.nameus = option_box.nameus
             self.anychar = option_box.anychar
             self.citattr = option_box.citattr
             self.placenote = option_box.placenote
+            # the private and living proxies change what is written
+            self.proxy_options = (option_box.private,
+                                  option_box.restrict_num)
             CONFIG.save()
         else:
             LOG.debug("pas dans OPTION %s")
@@ -161,11 +338,525 @@ class GedcomWriterforGeneanet(exportgedcom.GedcomWriter):
             self.relativepath = 0
             self.quaynote = 0
             self.zip = 0
+            self.zip_dedupe = 0
+            self.zip_incremental = 0
+            self.use_record_cache = 0
+            self.deterministic = 0
+            self.record_index = 0
             self.nameus = 1
             self.anychar = 1
             self.citattr = 1
             self.placenote = 0
+            self.proxy_options = (0, 0)
+        self.stat_threads = CONFIG.get("preferences.stat_threads")
+        # 0 means one thread per processor
+        self.zip_threads = (CONFIG.get("preferences.zip_threads") or
+                            os.cpu_count() or 1)
+        # deflate level of the medias the policy does not list, 0 stores them
+        self.zip_level = CONFIG.get("preferences.zip_level") or None
+        # overrides of the store/deflate policy, e.g. "image/tiff:9"
+        self.zip_policy = None
+        if self.zip:
+            self.zip_policy = parse_compression_policy(
+                CONFIG.get("preferences.zip_policy"))
+        # also compare the CRC of the medias kept from the previous zip
+        self.zip_verify = CONFIG.get("preferences.zip_verify")
+        self.record_cache = None
+        self.record_cache_size = CONFIG.get("preferences.record_cache_size")
+        self._recorder = None
+        self._stamps = {}
+        self._options_digest = None
+        # time stamped in the header of a deterministic export, 0 for the
+        # latest change in the tree
+        self.export_time = CONFIG.get("preferences.export_time")
+        # number of objects of each of the nine types kept in memory during
+        # the export, 0 for none: a count of entries, not a size in bytes
+        # (a person with its names and references may take some KB)
+        self.object_cache_size = CONFIG.get("preferences.object_cache_size")
+        # types of objects read up front, e.g. "event,place,citation", or
+        # "all"
+        prefetch = CONFIG.get("preferences.prefetch").replace(" ", "")
+        if prefetch == "all":
+            self.prefetch = list(PREFETCH_ITERATORS)
+        else:
+            self.prefetch = [kind for kind in prefetch.split(",")
+                             if kind in PREFETCH_ITERATORS]
+        # evaluate the filters once up front, see MaterializedDb
+        self.materialize = CONFIG.get("preferences.materialize")
+        # "I2" before "I10"
+        self.natural_order = CONFIG.get("preferences.natural_order")
+        # export only the branch of these people, e.g. "I0001,I0042":
+        # their "ancestors", "descendants" or "both", up to a number of
+        # generations (0 for all)
+        if option_box:
+            branch = (option_box.branch_roots, option_box.branch_direction,
+                      option_box.branch_generations)
+        else:
+            branch = (CONFIG.get("preferences.branch_roots"),
+                      CONFIG.get("preferences.branch_direction"),
+                      CONFIG.get("preferences.branch_generations"))
+        self.branch_roots = [gramps_id for gramps_id in
+                             branch[0].replace(" ", "").split(",")
+                             if gramps_id]
+        self.branch_direction = branch[1]
+        self.branch_generations = branch[2]
         self.zipfile = None
+        self._event_participants = {}
+        self._source_ids = {}
+        self._media_files = {}
+        self._place_dated = {}
+        self.place_names = ExportCache("place names")
+        self.place_maps = ExportCache("place coordinates")
+        self.place_addrs = ExportCache("place addresses")
+
+    def cache_stats(self):
+        """
+        Return the caches used by the export, for their hit/miss counts.
+        """
+        return [self.place_names, self.place_maps, self.place_addrs]
+
+    def _is_filtered(self):
+        """
+        Tell whether the export goes through filters (proxies).
+        """
+        dbase = self.dbase
+        if isinstance(dbase, CachedDb):
+            dbase = dbase.dbase
+        return isinstance(dbase, ProxyDbBase)
+
+    def _start_object_cache(self):
+        """
+        Put the export database behind an object cache, and prefetch the
+        chosen types of objects. With materialize, a filtered database is
+        rather read whole through its filters, once.
+        """
+        if self.materialize and self._is_filtered():
+            self.reset(_("Filtering the family tree"))
+            def materialized(kind, count):
+                self.progress_cnt += 1
+                self.update(self.progress_cnt)
+            start = time.time()
+            self.dbase = MaterializedDb(self.dbase, materialized)
+            LOG.info("%s in %.2fs", self.dbase, time.time() - start)
+            return
+        if self.object_cache_size or self.prefetch:
+            self.dbase = CachedDb(self.dbase, self.object_cache_size)
+        if self.prefetch:
+            self.reset(_("Reading the family tree"))
+            for kind in self.prefetch:
+                start = time.time()
+                count = self.dbase.prefetch(kind)
+                LOG.info("prefetch: %d %s objects in %.2fs", count, kind,
+                         time.time() - start)
+                self.progress_cnt += 1
+                self.update(self.progress_cnt)
+
+    def _stop_object_cache(self):
+        """
+        Drop the object cache, logging its statistics, or the materialized
+        view.
+        """
+        if isinstance(self.dbase, CachedDb):
+            for cache in self.dbase.caches.values():
+                LOG.info("%s", cache)
+            self.dbase = self.dbase.dbase
+        elif isinstance(self.dbase, MaterializedDb):
+            self.dbase = self.dbase.db
+
+    def _open_output(self, filename):
+        """
+        Open the GEDCOM file and the zip of the medias. A deterministic
+        export is written aside, see _close_output.
+        """
+        self.dirname = os.path.dirname (filename)
+        if self.deterministic:
+            output = io.open(filename + ".new", "wb")
+        else:
+            output = io.open(filename, "wb")
+        self.gedcom_file = GedcomEmitter(output, index=self.record_index)
+        if self.zip:
+            zipf = filename + ".zip"
+            self.zipfile = MediaArchive(zipf, self.zip_dedupe,
+                                        self.zip_threads, self.zip_level,
+                                        self.zip_policy,
+                                        self.zip_incremental,
+                                        self.zip_verify,
+                                        self.deterministic)
+
+    def _close_output(self, filename):
+        """
+        Close the GEDCOM file and the zip, and write the index of the
+        records, or remove the index of a previous export. The files of a
+        deterministic export only replace the previous ones if their
+        content changed.
+        """
+        self.gedcom_file.close()
+        if self.record_index:
+            self.gedcom_file.write_index(filename + ".idx")
+        elif os.path.exists(filename + ".idx"):
+            os.remove(filename + ".idx")
+        if self.deterministic:
+            if not replace_if_changed(filename + ".new", filename):
+                LOG.info("%s unchanged", filename)
+        if self.zip:
+            self.zipfile.close()
+            LOG.info("zip: %s", self.zipfile.stats())
+            for line in self.zipfile.mime_stats():
+                LOG.info("zip: %s", line)
+
+    def _export_time(self):
+        """
+        Return the time stamped in the header: now or, for a deterministic
+        export, preferences.export_time or else the latest change time in
+        the tree, read without building the objects where the backend
+        allows it.
+        """
+        if not self.deterministic:
+            return time.time()
+        if self.export_time:
+            return self.export_time
+        latest = last_change(self._base_database())
+        if latest is not None:
+            return latest
+        latest = 0
+        for objects in (self.dbase.iter_people(), self.dbase.iter_families(),
+                        self.dbase.iter_events(), self.dbase.iter_places(),
+                        self.dbase.iter_sources(),
+                        self.dbase.iter_citations(),
+                        self.dbase.iter_repositories(),
+                        self.dbase.iter_media(), self.dbase.iter_notes()):
+            for obj in objects:
+                latest = max(latest, obj.get_change_time())
+        return latest
+
+    def _build_event_participants(self):
+        """
+        Build the index used to write the witnesses: event handle -> list
+        of (gramps_id, gender, role, note list) for every person
+        referencing the event.
+
+        The references of the tree tell which events are shared by several
+        people or by a family, the only ones with witnesses to write, and
+        only the people referencing them are read. On other backends, it
+        is a single pass over the people.
+        """
+        shared = shared_events(self._base_database())
+        if shared is None:
+            (events, people) = (None, self.dbase.iter_people())
+        else:
+            (events, handles) = shared
+            people = (self.dbase.get_person_from_handle(handle)
+                      for handle in sorted(handles))
+        participants = {}
+        for person in people:
+            if person is None:
+                continue
+            gramps_id = person.get_gramps_id()
+            gender = person.get_gender()
+            for ref in person.get_event_ref_list():
+                if events is not None and ref.ref not in events:
+                    continue
+                participants.setdefault(ref.ref, []).append(
+                    (gramps_id, gender, ref.get_role(), ref.get_note_list()))
+        # ordered by ID rather than by the storage order of the people
+        for entries in participants.values():
+            entries.sort(key=lambda entry: entry[0])
+        return participants
+
+    def _build_source_ids(self):
+        """
+        Index the IDs of the sources, read from the raw data of the tree:
+        source handle -> gramps_id. The citations point to their source
+        by its ID without building it.
+        """
+        source_ids = dict((handle, gramps_id) for (gramps_id, handle)
+                          in raw_gramps_ids(self._base_database(), "source"))
+        if self._is_filtered():
+            kept = set(self.dbase.get_source_handles())
+            source_ids = dict((handle, gramps_id) for (handle, gramps_id)
+                              in source_ids.items() if handle in kept)
+        return source_ids
+
+    def _exported_media(self):
+        """
+        Return the media objects the export may write: all of them, or
+        through filters only those referred to by the people, families,
+        events, places, sources and citations remaining.
+        """
+        if not self._is_filtered():
+            return list(self.dbase.iter_media())
+        references = references_to(self._base_database(), "Media")
+        if references is None:
+            handles = set()
+            for (obj_class, iterator) in MEDIA_REFERRERS.items():
+                getter = getattr(self.dbase, "get_%s_from_handle" %
+                                 obj_class.lower())
+                for handle in getattr(self.dbase, iterator)():
+                    obj = getter(handle)
+                    if obj:
+                        handles.update(ref.ref for ref in obj.get_media_list())
+        else:
+            kept = {}
+            handles = set()
+            for (media, obj_class, handle) in references:
+                if obj_class not in MEDIA_REFERRERS or media in handles:
+                    continue
+                if obj_class not in kept:
+                    kept[obj_class] = set(getattr(
+                        self.dbase, MEDIA_REFERRERS[obj_class])())
+                if handle in kept[obj_class]:
+                    handles.add(media)
+        media = []
+        for handle in sorted(handles):
+            obj = self.dbase.get_media_from_handle(handle)
+            if obj:
+                media.append(obj)
+        return media
+
+    def _resolve_media(self):
+        """
+        Resolve the files of the media objects exported up front: media
+        handle -> (exists, full path, relative path, FORM). The files are
+        checked concurrently, stat being slow on network shares.
+        """
+        base = media_path(self.dbase)
+        media = [(obj.get_handle(),
+                  media_path_full(self.dbase, obj.get_path()),
+                  obj.get_mime_type())
+                 for obj in self._exported_media()]
+        with ThreadPoolExecutor(max_workers=max(1, self.stat_threads)) as pool:
+            found = list(pool.map(os.path.isfile,
+                                  [fullpath for (_h, fullpath, _m) in media]))
+        resolved = {}
+        for ((handle, fullpath, mime), exists) in zip(media, found):
+            if exists:
+                relpath = relative_path(fullpath, base)
+            else:
+                relpath = None
+            resolved[handle] = (exists, fullpath, relpath,
+                                MIME2GED.get(mime, mime))
+        return resolved
+
+    def _capture(self, kind, handle):
+        """
+        Render one record aside. Return its GEDCOM bytes, the medias to
+        store in the zip and the keys of what it depends on: the objects
+        read, the witness lists and the media files.
+        """
+        (gedcom_file, zipfile, dbase) = (self.gedcom_file, self.zipfile,
+                                         self.dbase)
+        buf = io.BytesIO()
+        self.gedcom_file = GedcomEmitter(buf)
+        self.zipfile = MediaQueue()
+        self._recorder = self.dbase = DependencyRecorder(dbase)
+        try:
+            obj = getattr(self.dbase, RECORD_GETTERS[kind])(handle)
+            if obj is not None:
+                getattr(self, RECORD_WRITERS[kind])(obj)
+            self.gedcom_file.flush()
+            return (buf.getvalue(), self.zipfile.items,
+                    sorted(self._recorder.keys))
+        finally:
+            self.gedcom_file = gedcom_file
+            self.zipfile = zipfile
+            self.dbase = dbase
+            self._recorder = None
+
+    def _depends(self, key):
+        """
+        Record that the record being captured depends on the stamp of key.
+        """
+        if self._recorder is not None:
+            self._recorder.keys.add(key)
+
+    def _stamp(self, key):
+        """
+        Return the stamp of a key a record may depend on, computed when
+        first asked for, so that only the objects the checked records
+        depend on are read.
+
+        Objects ("<type>:<handle>") are stamped with their change time or,
+        when seen through filters which may change them without changing
+        their time, with a digest of their data. A place is stamped with
+        its whole hierarchy, which its PLAC line is made of. Witness lists
+        ("w:" + event handle) and media files ("f:" + media handle) are
+        stamped with their content.
+        """
+        if key in self._stamps:
+            return self._stamps[key]
+        (kind, typed, handle) = key.partition(':')
+        if not typed:
+            # key of a record cached by a previous version
+            stamp = None
+        elif kind == "w":
+            participants = self._event_participants.get(handle, [])
+            stamp = hashlib.sha1(repr(
+                [(gramps_id, gender, role.serialize(), note_list)
+                 for (gramps_id, gender, role, note_list) in participants]
+                ).encode('utf-8')).hexdigest()
+        elif kind == "f":
+            stamp = repr(self._media_files.get(handle))
+        elif kind == "place":
+            parts = []
+            seen = set()
+            todo = [handle]
+            while todo:
+                current = todo.pop()
+                if current in seen:
+                    continue
+                seen.add(current)
+                place = self._stamped_object("place", current)
+                if place is None:
+                    continue
+                parts.append("%s:%s" % (current, self._object_stamp(place)))
+                todo.extend(placeref.ref
+                            for placeref in place.get_placeref_list())
+            stamp = "|".join(sorted(parts))
+        else:
+            obj = self._stamped_object(kind, handle)
+            stamp = None if obj is None else self._object_stamp(obj)
+        self._stamps[key] = stamp
+        return stamp
+
+    def _stamped_object(self, kind, handle):
+        """
+        Return the object of the given type, None when it was deleted or
+        is filtered out.
+        """
+        try:
+            return getattr(self.dbase, "get_%s_from_handle" % kind)(handle)
+        except HandleError:
+            return None
+
+    def _object_stamp(self, obj):
+        """
+        Stamp of one object: its change time, or the digest of its data
+        through filters.
+        """
+        if self._is_filtered():
+            return hashlib.sha1(pickle.dumps(obj.serialize())).hexdigest()
+        return obj.get_change_time()
+
+    def _build_options_digest(self):
+        """
+        Digest of the options and of the settings changing the records.
+        """
+        options = (RECORD_CACHE_VERSION, VERSION, os.linesep,
+                   media_path(self.dbase), self.include_witnesses,
+                   self.include_media, self.relativepath, self.include_depot,
+                   self.extended_role, self.quaynote, self.zip, self.nameus,
+                   self.anychar, self.citattr, self.placenote,
+                   self.proxy_options, glocale.lang,
+                   config.get("preferences.place-format"),
+                   config.get("preferences.place-auto"))
+        return hashlib.sha1(repr(options).encode('utf-8')).hexdigest()
+
+    def _record_digest(self, keys):
+        """
+        Digest of the options and of the current stamps of keys.
+        """
+        sha1 = hashlib.sha1(self._options_digest.encode('utf-8'))
+        for key in keys:
+            sha1.update(("\n%s=%s" % (key, self._stamp(key))).encode(
+                'utf-8'))
+        return sha1.hexdigest()
+
+    def _write_records(self, kind, handles):
+        """
+        Write the records of the given kind, in the order of handles.
+
+        Records still valid in the record cache are copied from it. The
+        others are rendered and cached. Without cache, they are simply
+        written.
+        """
+        self.set_total(max(1, len(handles)))
+        self.progress_cnt = 0
+        cache = self.record_cache
+        if cache is None:
+            get_object = getattr(self.dbase, RECORD_GETTERS[kind])
+            write_record = getattr(self, RECORD_WRITERS[kind])
+            for handle in handles:
+                obj = get_object(handle)
+                if obj is not None:
+                    write_record(obj)
+                self.progress_cnt += 1
+                self.update(self.progress_cnt)
+            return
+        for handle in handles:
+            entry = cache.lookup(handle)
+            if entry and self._record_digest(entry[0]) == entry[1]:
+                (data, medias) = cache.fetch(handle)
+            else:
+                (data, medias, keys) = self._capture(kind, handle)
+                cache.store(handle, keys, self._record_digest(keys),
+                            data, medias)
+            self.gedcom_file.write_bytes(data)
+            if self.zip:
+                for (fullpath, path, mime) in medias:
+                    self.zipfile.add(fullpath, path, mime)
+            self.progress_cnt += 1
+            self.update(self.progress_cnt)
+
+    def _base_database(self):
+        """
+        Return the tree under the object cache and the filters.
+        """
+        base = self.dbase
+        while isinstance(base, (CachedDb, ProxyDbBase)):
+            if isinstance(base, CachedDb):
+                base = base.dbase
+            else:
+                base = base.basedb
+        return base
+
+    def _sorted_ids(self, kind):
+        """
+        Return the (gramps_id, handle) of the records of a kind, sorted by
+        ID, or with natural_order by the numbers in the IDs ("I2" before
+        "I10"). The IDs are read from the raw data of the tree, without
+        building the objects; the filters only tell which records remain.
+        """
+        sorted_list = raw_gramps_ids(self._base_database(), kind)
+        if self._is_filtered():
+            handles = set(getattr(self.dbase, RECORD_HANDLES[kind])())
+            sorted_list = [data for data in sorted_list if data[1] in handles]
+        if self.natural_order:
+            sorted_list.sort(key=lambda data: (natural_key(data[0]), data))
+        else:
+            sorted_list.sort()
+        return sorted_list
+
+    def _individuals(self):
+        """
+        Write the individual people, sorted by ID.
+        """
+        self.reset(_("Writing individuals"))
+        self._write_records("person",
+                            [data[1] for data in self._sorted_ids("person")])
+
+    def _families(self):
+        """
+        Write the families, sorted by ID.
+        """
+        self.reset(_("Writing families"))
+        self._write_records("family",
+                            [data[1] for data in self._sorted_ids("family")])
+
+    def _notes(self):
+        """
+        Write the notes, sorted by ID.
+        """
+        self.reset(_("Writing notes"))
+        self._write_records("note",
+                            [data[1] for data in self._sorted_ids("note")])
+
+    def _event_witnesses(self, handle):
+        """
+        Return the (gramps_id, gender, role, note list) of the people
+        referencing the event.
+        """
+        self._depends("w:" + handle)
+        return self._event_participants.get(handle, [])
 
     def get_filtered_database(self, dbase, progress=None, preview=False):
         """
@@ -231,42 +922,58 @@ class GedcomWriterforGeneanet(exportgedcom.GedcomWriter):
         """
         if place is None:
             return
-        place_name = _pd.display(self.dbase, place, dateobj)
-        self._writeln(level, "PLAC", place_name.replace('\r', ' '), limit=120)
-        longitude = place.get_longitude()
-        latitude = place.get_latitude()
-        if longitude and latitude:
-            (latitude, longitude) = conv_lat_lon(latitude, longitude, "GEDCOM")
-        if longitude and latitude:
+        handle = place.get_handle()
+        if self._place_is_dated(place):
+            key = (handle, dateobj.serialize() if dateobj else None)
+        else:
+            key = handle
+        place_name = self.place_names.get(key)
+        if place_name is None:
+            place_name = _pd.display(self.dbase, place, dateobj).replace('\r', ' ')
+            self.place_names.set(key, place_name)
+        self._writeln(level, "PLAC", place_name, limit=120)
+
+        coords = self.place_maps.get(handle)
+        if coords is None:
+            longitude = place.get_longitude()
+            latitude = place.get_latitude()
+            if longitude and latitude:
+                (latitude, longitude) = conv_lat_lon(latitude, longitude, "GEDCOM")
+            if longitude and latitude:
+                coords = (latitude, longitude)
+            else:
+                coords = ()
+            self.place_maps.set(handle, coords)
+        if coords:
             self._writeln(level + 1, "MAP")
-            self._writeln(level + 2, 'LATI', latitude)
-            self._writeln(level + 2, 'LONG', longitude)
+            self._writeln(level + 2, 'LATI', coords[0])
+            self._writeln(level + 2, 'LONG', coords[1])
 
         # The Gedcom standard shows that an optional address structure can
         # be written out in the event detail.
         # http://homepages.rootsweb.com/~pmcbride/gedcom/55gcch2.htm#EVENT_DETAIL
-        location = get_main_location(self.dbase, place)
-        street = location.get(PlaceType.STREET)
-        locality = location.get(PlaceType.LOCALITY)
-        city = location.get(PlaceType.CITY)
-        state = location.get(PlaceType.STATE)
-        country = location.get(PlaceType.COUNTRY)
-        postal_code = place.get_code()
-
-        if street or locality or city or state or postal_code or country:
-            self._writeln(level, "ADDR", street)
-            if street:
-                self._writeln(level + 1, 'ADR1', street)
-            if locality:
-                self._writeln(level + 1, 'ADR2', locality)
-            if city:
-                self._writeln(level + 1, 'CITY', city)
-            if state:
-                self._writeln(level + 1, 'STAE', state)
-            if postal_code:
-                self._writeln(level + 1, 'POST', postal_code)
-            if country:
-                self._writeln(level + 1, 'CTRY', country)
+        address = self.place_addrs.get(handle)
+        if address is None:
+            location = get_main_location(self.dbase, place)
+            street = location.get(PlaceType.STREET)
+            locality = location.get(PlaceType.LOCALITY)
+            city = location.get(PlaceType.CITY)
+            state = location.get(PlaceType.STATE)
+            country = location.get(PlaceType.COUNTRY)
+            postal_code = place.get_code()
+            address = []
+            if street or locality or city or state or postal_code or country:
+                address.append((0, "ADDR", street))
+                for (token, value) in (('ADR1', street), ('ADR2', locality),
+                                       ('CITY', city), ('STAE', state),
+                                       ('POST', postal_code),
+                                       ('CTRY', country)):
+                    if value:
+                        address.append((1, token, value))
+            address = tuple(address)
+            self.place_addrs.set(handle, address)
+        for (sublevel, token, value) in address:
+            self._writeln(level + sublevel, token, value)
         if self.placenote:
             LOG.debug("PLACENOTE")
             self._note_references(place.get_note_list(), level)
@@ -274,6 +981,28 @@ class GedcomWriterforGeneanet(exportgedcom.GedcomWriter):
             LOG.debug(" PAS PLACENOTE")
             self._note_references(place.get_note_list(), level + 1)
 
+    def _place_is_dated(self, place):
+        """
+        Tell whether the name of the place, or of one of its enclosing
+        places, depends on the date.
+        """
+        handle = place.get_handle()
+        dated = self._place_dated.get(handle)
+        if dated is None:
+            # guards against loops in the hierarchy
+            self._place_dated[handle] = False
+            dated = any(not name.get_date_object().is_empty()
+                        for name in place.get_all_names())
+            for placeref in place.get_placeref_list():
+                if dated:
+                    break
+                if not placeref.get_date_object().is_empty():
+                    dated = True
+                else:
+                    parent = self.dbase.get_place_from_handle(placeref.ref)
+                    dated = parent is not None and self._place_is_dated(parent)
+            self._place_dated[handle] = dated
+        return dated
 
     def _names(self, person):
         """
@@ -312,53 +1041,29 @@ class GedcomWriterforGeneanet(exportgedcom.GedcomWriter):
         assert token
         if textlines:
             # break the line into multiple lines if a newline is found
-            textlines = textlines.replace('\n\r', '\n')
-            textlines = textlines.replace('\r', '\n')
-          #  LOG.debug("anychar %d" % self.anychar)
-            if self.anychar:
-                if not textlines.startswith('@'):  # avoid xrefs
-                    textlines = textlines.replace('@', '@@')
-            textlist = textlines.split('\n')
+            textlist = split_lines(textlines, self.anychar)
             token_level = level
             for text in textlist:
-                # make it unicode so that breakup below does the right thin.
-                text = str(text)
                 if limit:
-                    prefix = "\n%d CONC " % (level + 1)
-                    txt = prefix.join(self.breakup(text, limit))
+                    chunks = self.breakup(text, limit)
                 else:
-                    txt = text
-                self.gedcom_file.write("%d %s %s\n" %
-                                       (token_level, token, txt))
+                    chunks = [text]
+                self.gedcom_file.line(token_level, token,
+                                      chunks[0] if chunks else "")
+                for chunk in chunks[1:]:
+                    self.gedcom_file.line(level + 1, "CONC", chunk)
                 token_level = level + 1
                 token = "CONT"
         else:
-            self.gedcom_file.write("%d %s\n" % (level, token))
+            self.gedcom_file.tag(level, token)
 
     def breakup(self,txt, limit):
         """
-        Break a line of text into a list of strings that conform to the
-        maximum length specified, while breaking words in the middle of a word
-        to avoid issues with spaces.
-        """
-        if limit < 1:
-            raise ValueError("breakup: unexpected limit: %r" % limit)
-        data = []
-        while len(txt) > limit:
-            # look for non-space pair to break between
-            # do not break within a UTF-8 byte sequence, i. e. first char >127
-            idx = limit
-            while (idx > 0 and (txt[idx - 1].isspace() or txt[idx].isspace() or
-                            ord(txt[idx - 1]) > 127)):
-                idx -= 1
-            if idx == 0:
-                #no words to break on, just break at limit anyway
-                idx = limit
-            data.append(txt[:idx])
-            txt = txt[idx:]
-        if len(txt) > 0:
-            data.append(txt)
-        return data
+        Break a line of text into a list of strings whose UTF-8 encoding
+        conforms to the maximum length specified, while breaking words in
+        the middle of a word to avoid issues with spaces.
+        """
+        return breakup(txt, limit)
  
     def get_usuel_first_name(self,name):
         """
@@ -536,18 +1241,15 @@ class GedcomWriterforGeneanet(exportgedcom.GedcomWriter):
             photo_obj_id = photo.get_reference_handle()
             photo_obj = self.dbase.get_media_from_handle(photo_obj_id)
             if photo_obj:
-                mime = photo_obj.get_mime_type()
-                form = MIME2GED.get(mime, mime)
+                self._depends("f:" + photo_obj_id)
+                media = self._media_files.get(photo_obj_id)
+                if media is None or not media[0]:
+                    return
+                (exists, fullpath, relpath, form) = media
                 if self.relativepath:
-                    fullpath = media_path_full(self.dbase, photo_obj.get_path())
-                    if not os.path.isfile(fullpath):
-                        return
-                    base = media_path(self.dbase)
-                    path = relative_path(fullpath,base)
+                    path = relpath
                 else:
-                    path = media_path_full(self.dbase, photo_obj.get_path())
-                    if not os.path.isfile(path):
-                        return
+                    path = fullpath
                 self._writeln(level, 'OBJE')
                 if form:
                     self._writeln(level+1, 'FORM', form)
@@ -555,12 +1257,12 @@ class GedcomWriterforGeneanet(exportgedcom.GedcomWriter):
                 self._writeln(level+1, 'FILE', path, limit=255)
                 self._note_references(photo_obj.get_note_list(), level+1)
                 if self.zip:
-                    self._packzip(path)
+                    self._packzip(fullpath, path, photo_obj.get_mime_type())
  
  
-    def _packzip(self, path ):
+    def _packzip(self, fullpath, path, mime):
         if path:
-            self.zipfile.write(path)
+            self.zipfile.add(fullpath, path, mime)
 
     def _family_events(self, family):
         super(GedcomWriterforGeneanet, self)._family_events(family)
@@ -590,20 +1292,14 @@ class GedcomWriterforGeneanet(exportgedcom.GedcomWriter):
         super(GedcomWriterforGeneanet, self)._process_family_event(event,\
                                                                  event_ref)
         if self.include_witnesses:
-            for (objclass, handle) in self.dbase.find_backlink_handles(
-                event.handle, ['Person']):
-                person = self.dbase.get_person_from_handle(handle)
-                if person:
-                    for ref in person.get_event_ref_list():
-                        if ref.ref == event.handle:
-                            if int(ref.get_role()) in [EventRoleType.WITNESS,EventRoleType.CELEBRANT,\
-                        EventRoleType.INFORMANT,\
-                             EventRoleType.CLERGY, EventRoleType.AIDE, EventRoleType.CUSTOM]:
-                                level = 2
-                                self._writeln(level, "ASSO", "@%s@" % person.get_gramps_id())
-                                self._writeln(level+1, "TYPE", "INDI")
-                                self._writeln(level+1, "RELA", "Witness")
-                                self._note_references(ref.get_note_list(), level+1)
+            for (gramps_id, gender, role, note_list) in \
+                    self._event_witnesses(event.handle):
+                if int(role) in WITNESS_ROLES:
+                    level = 2
+                    self._writeln(level, "ASSO", "@%s@" % gramps_id)
+                    self._writeln(level+1, "TYPE", "INDI")
+                    self._writeln(level+1, "RELA", "Witness")
+                    self._note_references(note_list, level+1)
 
     def _sources(self):
         """
@@ -612,36 +1308,74 @@ class GedcomWriterforGeneanet(exportgedcom.GedcomWriter):
         self.reset(_("Writing sources"))
         self.progress_cnt += 1
         self.update(self.progress_cnt)
-        sorted_list = sort_handles_by_id(self.dbase.get_source_handles(),
-                                         self.dbase.get_source_from_handle)
+        self._write_records("source",
+                            [data[1] for data in self._sorted_ids("source")])
 
-        for (source_id, handle) in sorted_list:
-            source = self.dbase.get_source_from_handle(handle)
-            if source is None: continue
-            self._writeln(0, '@%s@' % source_id, 'SOUR')
-            if source.get_title():
-                self._writeln(1, 'TITL', source.get_title())
+    def _source_record(self, source):
+        """
+        Write one source record.
+        """
+        self._writeln(0, '@%s@' % source.get_gramps_id(), 'SOUR')
+        if source.get_title():
+            self._writeln(1, 'TITL', source.get_title())
 
-            if source.get_author():
-                self._writeln(1, "AUTH", source.get_author())
+        if source.get_author():
+            self._writeln(1, "AUTH", source.get_author())
 
-            if source.get_publication_info():
-                self._writeln(1, "PUBL", source.get_publication_info())
+        if source.get_publication_info():
+            self._writeln(1, "PUBL", source.get_publication_info())
 
-            if source.get_abbreviation():
-                self._writeln(1, 'ABBR', source.get_abbreviation())
+        if source.get_abbreviation():
+            self._writeln(1, 'ABBR', source.get_abbreviation())
 
-            self._photos(source.get_media_list(), 1)
+        self._photos(source.get_media_list(), 1)
 
-            if self.include_depot:
-                for reporef in source.get_reporef_list():
-                    self._reporef(reporef, 1)
-                    break
+        if self.include_depot:
+            for reporef in source.get_reporef_list():
+                self._reporef(reporef, 1)
+                break
 
-            self._note_references(source.get_note_list(), 1)
-            self._change(source.get_change_time(), 1)
+        self._note_references(source.get_note_list(), 1)
+        self._change(source.get_change_time(), 1)
+
+    def _repos(self):
+        """
+        Write out the list of repositories, sorting by Gramps ID.
+        """
+        self.reset(_("Writing repositories"))
+        self.progress_cnt += 1
+        self.update(self.progress_cnt)
+        self._write_records("repository", [
+            data[1] for data in self._sorted_ids("repository")])
+
+    def _repo_record(self, repo):
+        """
+        REPOSITORY_RECORD:=
+        n @<XREF:REPO>@ REPO {1:1}
+        +1 NAME <NAME_OF_REPOSITORY> {1:1}
+        +1 <<ADDRESS_STRUCTURE>> {0:1}
+        +1 <<NOTE_STRUCTURE>> {0:M}
+        +1 REFN <USER_REFERENCE_NUMBER> {0:M}
+        +2 TYPE <USER_REFERENCE_TYPE> {0:1}
+        +1 RIN <AUTOMATED_RECORD_ID> {0:1}
+        +1 <<CHANGE_DATE>> {0:1}
+        """
+        self._writeln(0, "@%s@" % repo.get_gramps_id(), "REPO")
+        if repo.get_name():
+            self._writeln(1, "NAME", repo.get_name())
+        for addr in repo.get_address_list():
+            self._GedcomWriter__write_addr(1, addr)
+            if addr.get_phone():
+                self._writeln(1, "PHON", addr.get_phone())
+        for url in repo.get_url_list():
+            if url.get_type() == UrlType.EMAIL:
+                self._writeln(1, "EMAIL", url.get_path())
+            elif url.get_type() == UrlType.WEB_HOME:
+                self._writeln(1, "WWW", url.get_path())
+            elif url.get_type() == _("FAX"):
+                self._writeln(1, "FAX", url.get_path())
+        self._note_references(repo.get_note_list(), 1)
 
- 
     def _person_event_ref(self, key, event_ref):
         """
         Write the witnesses associated with the birth and death event. 
@@ -652,29 +1386,20 @@ class GedcomWriterforGeneanet(exportgedcom.GedcomWriter):
             role = int(event_ref.get_role())
             if role != EventRoleType.PRIMARY:
                 return
-            event = self.dbase.get_event_from_handle(event_ref.ref)
-            etype = int(event.get_type())
-            devel = 2
-            for (objclass, handle) in self.dbase.find_backlink_handles(
-                event.handle, ['Person']):
-                person = self.dbase.get_person_from_handle(handle)
-                if person:
-                    for ref in person.get_event_ref_list():
-                        devel = 2
-                        if (ref.ref == event.handle): 
-                            role = int(ref.get_role())
-                            if int(ref.get_role()) in [EventRoleType.WITNESS,EventRoleType.CELEBRANT, EventRoleType.INFORMANT, EventRoleType.AIDE ,EventRoleType.CLERGY, EventRoleType.AIDE,EventRoleType.CUSTOM]:
-                                level = 2
-                                rol = role + 1
-                                self._writeln(level, "ASSO", "@%s@" % person.get_gramps_id())
-                                self._writeln(level+1, "TYPE", "INDI")
-                                self._writeln(level+1, "RELA", "Witness")
-                                if self.extended_role:
-                                    if role:
-                                        self._writeln(level+1, "NOTE", '\xA0%s' % EventRoleType._DATAMAP[rol][1])
-                                    else:
-                                        self._writeln(level+1, "NOTE", '\xA0%s' % str(ref.role))
-                                self._note_references(ref.get_note_list(), level+1)
+            for (gramps_id, gender, role, note_list) in \
+                    self._event_witnesses(event_ref.ref):
+                if int(role) in WITNESS_ROLES:
+                    level = 2
+                    rol = int(role) + 1
+                    self._writeln(level, "ASSO", "@%s@" % gramps_id)
+                    self._writeln(level+1, "TYPE", "INDI")
+                    self._writeln(level+1, "RELA", "Witness")
+                    if self.extended_role:
+                        if int(role):
+                            self._writeln(level+1, "NOTE", '\xA0%s' % EventRoleType._DATAMAP[rol][1])
+                        else:
+                            self._writeln(level+1, "NOTE", '\xA0%s' % str(role))
+                    self._note_references(note_list, level+1)
 
     def _process_person_event(self, person ,event ,event_ref):
         """
@@ -688,55 +1413,45 @@ class GedcomWriterforGeneanet(exportgedcom.GedcomWriter):
         role = int(event_ref.get_role())
         if role != EventRoleType.PRIMARY:
             return
-        devel = 2
         if self.include_witnesses:
+            participants = [entry for entry in
+                            self._event_witnesses(event.handle)
+                            if entry[0] != person.get_gramps_id()]
             if etype in (EventType.BAPTISM, EventType.CHRISTEN):
-                for (objclass, handle) in self.dbase.find_backlink_handles(
-                    event.handle, ['Person']):
-                    person2 = self.dbase.get_person_from_handle(handle)
-                    if person2 and person2 != person:
-                        for ref in person2.get_event_ref_list():
-                            if (ref.ref == event.handle):
-                                if (int(ref.get_role()) == EventRoleType.CUSTOM):
-                                    level = 1
-                                    self._writeln(level, "ASSO", "@%s@" % person2.get_gramps_id())
-                                    self._writeln(level+1, "TYPE", "INDI")
-                                    if person2.get_gender() == Person.MALE:
-                                        self._writeln(level+1, "RELA", "Godfather")
-                                    elif person2.get_gender() == Person.FEMALE:
-                                        self._writeln(level+1, "RELA", "Godmother")
-                                    else:
-                                        self._writeln(level+1, "RELA", "Unknown")
-
-                                    self._note_references(ref.get_note_list(), level+1)
-                                else:
-                                    level = 2
-                                    self._writeln(level, "ASSO", "@%s@" % person2.get_gramps_id())
-                                    self._writeln(level+1, "TYPE", "INDI")
-                                    self._writeln(level+1, "RELA", "Witness")
-                                    self._note_references(ref.get_note_list(), level+1)
+                for (gramps_id, gender, role, note_list) in participants:
+                    if int(role) == EventRoleType.CUSTOM:
+                        level = 1
+                        self._writeln(level, "ASSO", "@%s@" % gramps_id)
+                        self._writeln(level+1, "TYPE", "INDI")
+                        if gender == Person.MALE:
+                            self._writeln(level+1, "RELA", "Godfather")
+                        elif gender == Person.FEMALE:
+                            self._writeln(level+1, "RELA", "Godmother")
+                        else:
+                            self._writeln(level+1, "RELA", "Unknown")
+
+                        self._note_references(note_list, level+1)
+                    else:
+                        level = 2
+                        self._writeln(level, "ASSO", "@%s@" % gramps_id)
+                        self._writeln(level+1, "TYPE", "INDI")
+                        self._writeln(level+1, "RELA", "Witness")
+                        self._note_references(note_list, level+1)
             else:
-                devel = 2
-                for (objclass, handle) in self.dbase.find_backlink_handles(
-                    event.handle, ['Person']):
-                    person2 = self.dbase.get_person_from_handle(handle)
-                    if person2 and person != person2:
-                        for ref in person2.get_event_ref_list():
-                            if (ref.ref == event.handle):  
-                                role=int(ref.get_role())
-                                if int(ref.get_role()) in [EventRoleType.WITNESS, EventRoleType.CELEBRANT, EventRoleType.INFORMANT, EventRoleType.AIDE, EventRoleType.CLERGY, EventRoleType.AIDE, EventRoleType.CUSTOM]:
-                                    level = 2
+                for (gramps_id, gender, role, note_list) in participants:
+                    if int(role) in WITNESS_ROLES:
+                        level = 2
 #pylint: disable=maybe-no-member
-                                    rol = role + 1
-                                    self._writeln(level, "ASSO", "@%s@" % person2.get_gramps_id())
-                                    self._writeln(level+1, "TYPE", "INDI")
-                                    self._writeln(level+1, "RELA", "Witness")
-                                    if self.extended_role:
-                                        if role:
-                                            self._writeln(level+1, "NOTE", '\xA0%s' % EventRoleType._DATAMAP[rol][1])
-                                        else:
-                                            self._writeln(level+1, "NOTE", '\xA0%s' % str(ref.role))
-                                    self._note_references(ref.get_note_list(), level+1)
+                        rol = int(role) + 1
+                        self._writeln(level, "ASSO", "@%s@" % gramps_id)
+                        self._writeln(level+1, "TYPE", "INDI")
+                        self._writeln(level+1, "RELA", "Witness")
+                        if self.extended_role:
+                            if int(role):
+                                self._writeln(level+1, "NOTE", '\xA0%s' % EventRoleType._DATAMAP[rol][1])
+                            else:
+                                self._writeln(level+1, "NOTE", '\xA0%s' % str(role))
+                        self._note_references(note_list, level+1)
 
     def _attributes(self, person):
         """
@@ -818,7 +1533,11 @@ class GedcomWriterforGeneanet(exportgedcom.GedcomWriter):
             +2 [CONT|CONC] <GEDCOM_CONTENT_DESCRIPTION> {0:M}
 
         """
-        local_time = time.localtime(time.time())
+        if self.deterministic:
+            # independent of the time zone of the computer
+            local_time = time.gmtime(self._export_time())
+        else:
+            local_time = time.localtime(self._export_time())
         (year, mon, day, hour, minutes, sec) = local_time[0:6]
         date_str = "%d %s %d" % (day, libgedcom.MONTH[mon], year)
         time_str = "%02d:%02d:%02d" % (hour, minutes, sec)
@@ -859,12 +1578,13 @@ class GedcomWriterforGeneanet(exportgedcom.GedcomWriter):
         if src_handle is None:
             return
 
-        src = self.dbase.get_source_from_handle(src_handle)
-        if src is None:
+        self._depends("source:" + src_handle)
+        src_id = self._source_ids.get(src_handle)
+        if src_id is None:
             return
 
         # Reference to the source
-        self._writeln(level, "SOUR", "@%s@" % src.get_gramps_id())
+        self._writeln(level, "SOUR", "@%s@" % src_id)
         if citation.get_page() != "":
             # PAGE <WHERE_WITHIN_SOURCE> can not have CONC lines.
             # WHERE_WITHIN_SOURCE:= {Size=1:248}
@@ -900,10 +1620,10 @@ class GedcomWriterforGeneanet(exportgedcom.GedcomWriter):
 
         if len(citation.get_note_list()) > 0:
 
-            note_list = [self.dbase.get_note_from_handle(h)
-                         for h in citation.get_note_list()]
-            note_list = [n for n in note_list
-                         if n.get_type() == NoteType.SOURCE_TEXT]
+            notes = [self.dbase.get_note_from_handle(h)
+                     for h in citation.get_note_list()]
+            note_list = [n for n in notes
+                         if n and n.get_type() == NoteType.SOURCE_TEXT]
 
             if note_list:
                 ref_text = note_list[0].get()
@@ -915,9 +1635,7 @@ class GedcomWriterforGeneanet(exportgedcom.GedcomWriter):
             if ref_text != "":
                 self._writeln(level + 2, "TEXT", ref_text)
 
-            note_list = [self.dbase.get_note_from_handle(h)
-                         for h in citation.get_note_list()]
-            note_list = [n.handle for n in note_list
+            note_list = [n.handle for n in notes
                          if n and n.get_type() != NoteType.SOURCE_TEXT]
             self._note_references(note_list, level + 1)
 
@@ -943,31 +1661,274 @@ class GedcomWriterforGeneanet(exportgedcom.GedcomWriter):
         """
         Write the actual GEDCOM file to the specified filename.
         """
+        database = self.dbase
+        if self.branch_roots:
+            self._select_branch()
+        self._start_object_cache()
+        try:
+            return self._write_gedcom(filename)
+        finally:
+            self._stop_object_cache()
+            self.dbase = database
+
+    def _select_branch(self):
+        """
+        Restrict the export to the branch of the branch_roots, found by a
+        walk of the families of the tree read once, rather than by a
+        person filter. The sources, notes, medias, ... written are those
+        the people and families of the branch refer to.
+        """
+        self.reset(_("Selecting the branch"))
+        LOG.warning("branch: export restricted to the %s of %s, %s "
+                    "generations", self.branch_direction,
+                    ",".join(self.branch_roots),
+                    self.branch_generations or "all")
+        start = time.time()
+        base = self._base_database()
+        ids = dict(raw_gramps_ids(base, "person"))
+        roots = []
+        for gramps_id in self.branch_roots:
+            if gramps_id in ids:
+                roots.append(ids[gramps_id])
+            else:
+                LOG.warning("branch: no person %s", gramps_id)
+        (people, families) = KinshipIndex(base).branch(
+            roots, self.branch_direction != "descendants",
+            self.branch_direction != "ancestors", self.branch_generations)
+        dbase = self.dbase
+        if self._is_filtered():
+            people &= set(dbase.iter_person_handles())
+            families &= set(dbase.iter_family_handles())
+        dbase = CachedFilterProxyDb(dbase, {
+            "plist" : people,
+            "flist" : families,
+            "elist" : set(dbase.iter_event_handles()),
+            "nlist" : set(dbase.iter_note_handles()),
+            })
+        self.dbase = ReferencedBySelectionProxyDb(dbase, all_people=True)
+        LOG.info("branch: %d people, %d families in %.2fs", len(people),
+                 len(families), time.time() - start)
+        self.progress_cnt += 1
+        self.update(self.progress_cnt)
 
-        self.dirname = os.path.dirname (filename)
-        self.gedcom_file = io.open(filename, "w", encoding='utf-8')
-        if self.zip:
-            zipf = filename + ".zip"
-            self.zipfile = zipfile.ZipFile(zipf,'w')
-            if not self.zipfile:
-                raise Exception('fichier zip %s non ouvert' % zipf)
+    def _write_gedcom(self, filename):
+        """
+        Write the GEDCOM file, the objects being cached.
+        """
+        self._open_output(filename)
         
         LOG.debug("deb write gedcom %d" % self.relativepath)
+        if self.include_witnesses:
+            self._event_participants = self._build_event_participants()
+        self._source_ids = self._build_source_ids()
+        if self.include_media:
+            self._media_files = self._resolve_media()
+        self._place_dated = {}
+        for cache in self.cache_stats():
+            cache.clear()
         self._header(filename)
         self._submitter()
+        if self.use_record_cache:
+            self._stamps = {}
+            self._options_digest = self._build_options_digest()
+            self.record_cache = RecordCache(
+                filename + ".cache", self.record_cache_size << 20)
         self._individuals()
         self._families()
         self._sources()
         self._repos()
         self._notes()
+        if self.record_cache is not None:
+            self.record_cache.close()
+            LOG.info("%s", self.record_cache)
+            self.record_cache = None
+            self._stamps = {}
         self._writeln(0, "TRLR")
-        self.gedcom_file.close()
-        if self.zip:
-            self.zipfile.close()
+        self._close_output(filename)
+        self._event_participants = {}
+        self._source_ids = {}
+        self._media_files = {}
+        for cache in self.cache_stats():
+            LOG.info("%s", cache)
         return True
 
 
 #-------------------------------------------------------------------------
+#
+# Delta export
+#
+#-------------------------------------------------------------------------
+class GedcomDeltaWriterforGeneanet(GedcomWriterforGeneanet):
+    """
+    Write only the INDI, FAM, SOUR, REPO and NOTE records new or changed
+    since the previous delta export, with the records they point to.
+
+    The manifest of the previous export (<file>.manifest) keeps, for each
+    record, its ID, the keys of what it depends on and their digest as
+    for the record cache, and the hash of its lines. Records whose digest
+    did not change are not rendered again. Records rendered again with the
+    same lines are left out. The IDs of the records deleted, or whose ID
+    changed, are listed in <file>.deleted.
+    """
+    def _write_gedcom(self, filename):
+        """
+        Write the delta GEDCOM file to the specified filename.
+        """
+        self._open_output(filename)
+        if self.include_witnesses:
+            self._event_participants = self._build_event_participants()
+        self._source_ids = self._build_source_ids()
+        if self.include_media:
+            self._media_files = self._resolve_media()
+        self._place_dated = {}
+        for cache in self.cache_stats():
+            cache.clear()
+        self._stamps = {}
+        self._options_digest = self._build_options_digest()
+        previous = load_manifest(filename + ".manifest", self._options_digest)
+
+        self.reset(_("Looking for the changed records"))
+        sorted_lists = []
+        records = {}
+        rendered = {}
+        ids = {}
+        changed = 0
+        for kind in DELTA_KINDS:
+            sorted_list = self._sorted_ids(kind)
+            sorted_lists.append((kind, sorted_list))
+            for (gramps_id, handle) in sorted_list:
+                ids[gramps_id] = handle
+                entry = previous.get(handle)
+                if (entry is not None and entry[1] == gramps_id and
+                        self._record_digest(entry[2]) == entry[3]):
+                    records[handle] = entry
+                    continue
+                (data, medias, keys) = self._capture(kind, handle)
+                changed += 1
+                content = hashlib.sha1(data).hexdigest()
+                records[handle] = [kind, gramps_id, keys,
+                                   self._record_digest(keys), content]
+                if entry is None or entry[4] != content:
+                    rendered[handle] = (data, medias)
+                self.progress_cnt += 1
+                self.update(self.progress_cnt)
+        wanted = set(rendered)
+        for (data, medias) in rendered.values():
+            for gramps_id in referenced_ids(data):
+                if gramps_id in ids:
+                    wanted.add(ids[gramps_id])
+        deleted = sorted(entry[1] for (handle, entry) in previous.items()
+                         if handle not in records or
+                         records[handle][1] != entry[1])
+
+        self._header(filename)
+        self._submitter()
+        self.reset(_("Writing the changed records"))
+        for (kind, sorted_list) in sorted_lists:
+            for (gramps_id, handle) in sorted_list:
+                if handle not in wanted:
+                    continue
+                if handle in rendered:
+                    (data, medias) = rendered.pop(handle)
+                else:
+                    (data, medias, keys) = self._capture(kind, handle)
+                self.gedcom_file.write_bytes(data)
+                if self.zip:
+                    for (fullpath, path, mime) in medias:
+                        self.zipfile.add(fullpath, path, mime)
+                self.progress_cnt += 1
+                self.update(self.progress_cnt)
+        self._writeln(0, "TRLR")
+        self._close_output(filename)
+        with io.open(filename + ".deleted", "w", encoding="utf-8") as fileobj:
+            for gramps_id in deleted:
+                fileobj.write(gramps_id + "\n")
+        save_manifest(filename + ".manifest", self._options_digest, records)
+        LOG.info("delta: %d records written, %d changed, %d deleted",
+                 len(wanted), changed, len(deleted))
+        self._event_participants = {}
+        self._source_ids = {}
+        self._media_files = {}
+        self._stamps = {}
+        return True
+
+#-------------------------------------------------------------------------
+#
+# Preview counts
+#
+#-------------------------------------------------------------------------
+# People filtered or counted per preview step, between two GTK events
+PREVIEW_SLICE = 500
+
+# Types of objects whose signals tell that a tree changed
+CHANGE_SIGNALS = ("person", "family", "event", "place", "source", "citation",
+                  "media", "repository", "note", "tag")
+
+# Counts of the previews of the option box: (tree, change stamp, filter
+# settings) -> list of (proxy name, number of people), for the session
+_PREVIEW_COUNTS = {}
+
+# Handles left by the export filters, see FilterCache. Bump the version
+# when the filters or the proxies select other objects.
+FILTER_CACHE = os.path.join(USER_PLUGINS, "gedcomforgeneanet-filters.db")
+FILTER_CACHE_VERSION = 1
+
+# Changes of the trees opened during the session: id -> (weak reference to
+# the tree, serial of the stamp, [number of changes], keys of the signals)
+_TREE_CHANGES = {}
+_TREE_SERIAL = itertools.count()
+# The DbState whose signals release the trees
+_WATCHED_STATES = weakref.WeakSet()
+
+def tree_stamp(dbstate):
+    """
+    Return the change stamp of the tree open in dbstate: its ID, the
+    serial of its stamp and the number of changes signalled since it was
+    first stamped. The signals are disconnected when the tree is closed.
+    """
+    dbase = dbstate.db
+    entry = _TREE_CHANGES.get(id(dbase))
+    if entry is None or entry[0]() is not dbase:
+        if dbstate not in _WATCHED_STATES:
+            _WATCHED_STATES.add(dbstate)
+            dbstate.connect("database-changed", release_trees)
+            dbstate.connect("no-database", release_trees)
+        changes = [0]
+        def changed(*args):
+            changes[0] += 1
+        keys = [dbase.connect("%s-%s" % (kind, action), changed)
+                for kind in CHANGE_SIGNALS
+                for action in ("add", "update", "delete", "rebuild")]
+        entry = _TREE_CHANGES[id(dbase)] = (weakref.ref(dbase),
+                                            next(_TREE_SERIAL), changes, keys)
+    return (dbase.get_dbid(), entry[1], entry[2][0])
+
+def release_trees(current=None):
+    """
+    Disconnect the change signals of the trees other than current, which
+    were closed.
+    """
+    for (ident, (ref, serial, changes, keys)) in list(_TREE_CHANGES.items()):
+        dbase = ref()
+        if dbase is current and dbase is not None:
+            continue
+        del _TREE_CHANGES[ident]
+        if dbase is not None:
+            for key in keys:
+                dbase.disconnect(key)
+
+def filter_key(gfilter):
+    """
+    Key of the settings of a filter, None for no filter. Filters edited
+    during the session get another key.
+    """
+    if gfilter is None or gfilter.is_empty():
+        return None
+    return (gfilter.get_name(), gfilter.get_logical_op(),
+            gfilter.get_invert(), tuple(
+                (rule.__class__.__name__, tuple(rule.list), rule.use_regex)
+                for rule in gfilter.get_rules()))
+
 #-------------------------------------------------------------------------
 #
 # GedcomWriter Options
@@ -997,6 +1958,19 @@ class GedcomWriterOptionBox(WriterOptionBox):
         self.quaynote_check = None
         self.zip = CONFIG.get("preferences.zip")
         self.zip_check = None
+        self.zip_dedupe = CONFIG.get("preferences.zip_dedupe")
+        self.zip_dedupe_check = None
+        self.zip_incremental = CONFIG.get("preferences.zip_incremental")
+        self.zip_incremental_check = None
+        self.use_record_cache = CONFIG.get("preferences.record_cache")
+        self.use_record_cache_check = None
+        self.deterministic = CONFIG.get("preferences.deterministic")
+        self.deterministic_check = None
+        self.record_index = CONFIG.get("preferences.record_index")
+        self.record_index_check = None
+        self.use_filter_cache = CONFIG.get("preferences.filter_cache")
+        self.use_filter_cache_check = None
+        self._tree_content = None
         self.nameus = CONFIG.get("preferences.nameus")
         self.nameus_check = None
         self.anychar = CONFIG.get("preferences.anychar")
@@ -1005,6 +1979,16 @@ class GedcomWriterOptionBox(WriterOptionBox):
         self.citattr_check = None
         self.placenote = CONFIG.get("preferences.placenote")
         self.placenote_check = None
+        # experimental, unverified: decide who is living for the whole
+        # tree at once, see LivingEngine
+        self.bulk_living = CONFIG.get("preferences.experimental_bulk_living")
+        self.branch_roots = CONFIG.get("preferences.branch_roots")
+        self.branch_roots_entry = None
+        self.branch_direction = CONFIG.get("preferences.branch_direction")
+        self.branch_direction_combo = None
+        self.branch_generations = CONFIG.get("preferences.branch_generations")
+        self.branch_generations_spin = None
+        self._preview_job = None
 
     def get_option_box(self):
         option_box = super(GedcomWriterOptionBox, self).get_option_box()
@@ -1016,10 +2000,16 @@ class GedcomWriterOptionBox(WriterOptionBox):
         self.extended_role_check = Gtk.CheckButton(_("Role Display for Events"))
         self.quaynote_check = Gtk.CheckButton(_("Export Source Quality"))
         self.zip_check = Gtk.CheckButton(_("Create a zip of medias"))
+        self.zip_dedupe_check = Gtk.CheckButton(_("Store identical medias only once in the zip"))
+        self.zip_incremental_check = Gtk.CheckButton(_("Update the zip incrementally"))
         self.nameus_check = Gtk.CheckButton(_("Support for call name"))
         self.anychar_check = Gtk.CheckButton(_("Implementation of anychar"))
         self.citattr_check = Gtk.CheckButton(_("Export of attributes of citation"))
         self.placenote_check = Gtk.CheckButton(_("Increase level of place note"))
+        self.use_record_cache_check = Gtk.CheckButton(_("Reuse the unchanged records of the previous export"))
+        self.deterministic_check = Gtk.CheckButton(_("Reproducible output (unchanged tree, identical files)"))
+        self.record_index_check = Gtk.CheckButton(_("Write the offsets of the records in an index (.idx)"))
+        self.use_filter_cache_check = Gtk.CheckButton(_("Reuse the filter results of a previous export of the unchanged tree"))
         #self.include_witnesses_check.set_active(1)
         self.include_witnesses_check.set_active(CONFIG.get("preferences.include_witnesses"))
         self.include_media_check.set_active(CONFIG.get("preferences.include_media"))
@@ -1028,10 +2018,34 @@ class GedcomWriterOptionBox(WriterOptionBox):
         self.extended_role_check.set_active(CONFIG.get("preferences.extended_role"))
         self.quaynote_check.set_active(CONFIG.get("preferences.quaynote"))
         self.zip_check.set_active(CONFIG.get("preferences.zip"))
+        self.zip_dedupe_check.set_active(CONFIG.get("preferences.zip_dedupe"))
+        self.zip_incremental_check.set_active(CONFIG.get("preferences.zip_incremental"))
         self.nameus_check.set_active(CONFIG.get("preferences.nameus"))
         self.anychar_check.set_active(CONFIG.get("preferences.anychar"))
         self.citattr_check.set_active(CONFIG.get("preferences.citattr"))
         self.placenote_check.set_active(CONFIG.get("preferences.placenote"))
+        self.use_record_cache_check.set_active(CONFIG.get("preferences.record_cache"))
+        self.deterministic_check.set_active(CONFIG.get("preferences.deterministic"))
+        self.record_index_check.set_active(CONFIG.get("preferences.record_index"))
+        self.use_filter_cache_check.set_active(CONFIG.get("preferences.filter_cache"))
+        self.branch_roots_entry = Gtk.Entry()
+        self.branch_roots_entry.set_text(CONFIG.get("preferences.branch_roots"))
+        self.branch_roots_entry.set_tooltip_text(_("IDs of the people, e.g. I0001,I0042, empty to export the whole tree"))
+        self.branch_direction_combo = Gtk.ComboBoxText()
+        self.branch_direction_combo.append("both", _("Ancestors and descendants"))
+        self.branch_direction_combo.append("ancestors", _("Ancestors"))
+        self.branch_direction_combo.append("descendants", _("Descendants"))
+        if not self.branch_direction_combo.set_active_id(CONFIG.get("preferences.branch_direction")):
+            self.branch_direction_combo.set_active_id("both")
+        self.branch_generations_spin = Gtk.SpinButton.new_with_range(0, 999, 1)
+        self.branch_generations_spin.set_value(CONFIG.get("preferences.branch_generations"))
+        self.branch_generations_spin.set_tooltip_text(_("0 for all the generations"))
+        branch_box = Gtk.Box()
+        branch_box.pack_start(Gtk.Label(label=_("Export only the branch of:")), False, False, 0)
+        branch_box.pack_start(self.branch_roots_entry, True, True, 0)
+        branch_box.pack_start(self.branch_direction_combo, False, False, 0)
+        branch_box.pack_start(Gtk.Label(label=_("Generations:")), False, False, 0)
+        branch_box.pack_start(self.branch_generations_spin, False, False, 0)
 
         # Add to gui:
         option_box.pack_start(self.include_witnesses_check, False, False, 0)
@@ -1041,10 +2055,18 @@ class GedcomWriterOptionBox(WriterOptionBox):
         option_box.pack_start(self.extended_role_check, False, False, 0)
         option_box.pack_start(self.quaynote_check, False, False, 0)
         option_box.pack_start(self.zip_check, False, False, 0)
+        option_box.pack_start(self.zip_dedupe_check, False, False, 0)
+        option_box.pack_start(self.zip_incremental_check, False, False, 0)
         option_box.pack_start(self.nameus_check, False, False, 0)
         option_box.pack_start(self.anychar_check, False, False, 0)
         option_box.pack_start(self.citattr_check, False, False, 0)
         option_box.pack_start(self.placenote_check, False, False, 0)
+        option_box.pack_start(self.use_record_cache_check, False, False, 0)
+        option_box.pack_start(self.deterministic_check, False, False, 0)
+        option_box.pack_start(self.record_index_check, False, False, 0)
+        option_box.pack_start(self.use_filter_cache_check, False, False, 0)
+        option_box.pack_start(branch_box, False, False, 0)
+        self.preview_button.connect("destroy", self._cancel_preview)
         return option_box
 
     def parse_options(self):
@@ -1066,6 +2088,10 @@ class GedcomWriterOptionBox(WriterOptionBox):
             self.quaynote = self.quaynote_check.get_active()
         if self.zip_check:
             self.zip = self.zip_check.get_active()
+        if self.zip_dedupe_check:
+            self.zip_dedupe = self.zip_dedupe_check.get_active()
+        if self.zip_incremental_check:
+            self.zip_incremental = self.zip_incremental_check.get_active()
         if self.nameus_check:
             self.nameus = self.nameus_check.get_active()
         if self.anychar_check:
@@ -1074,6 +2100,20 @@ class GedcomWriterOptionBox(WriterOptionBox):
             self.citattr = self.citattr_check.get_active()
         if self.placenote_check:
             self.placenote = self.placenote_check.get_active()
+        if self.use_record_cache_check:
+            self.use_record_cache = self.use_record_cache_check.get_active()
+        if self.deterministic_check:
+            self.deterministic = self.deterministic_check.get_active()
+        if self.record_index_check:
+            self.record_index = self.record_index_check.get_active()
+        if self.use_filter_cache_check:
+            self.use_filter_cache = self.use_filter_cache_check.get_active()
+        if self.branch_roots_entry:
+            self.branch_roots = self.branch_roots_entry.get_text().strip()
+        if self.branch_direction_combo:
+            self.branch_direction = self.branch_direction_combo.get_active_id()
+        if self.branch_generations_spin:
+            self.branch_generations = self.branch_generations_spin.get_value_as_int()
         CONFIG.set("preferences.include_witnesses" , self.include_witnesses )
         CONFIG.set("preferences.include_media" , self.include_media)
         CONFIG.set("preferences.include_depot" , self.include_depot)
@@ -1081,19 +2121,301 @@ class GedcomWriterOptionBox(WriterOptionBox):
         CONFIG.set("preferences.relativepath" , self.relativepath)
         CONFIG.set("preferences.quaynote" , self.quaynote)
         CONFIG.set("preferences.zip" , self.zip)
+        CONFIG.set("preferences.zip_dedupe" , self.zip_dedupe)
+        CONFIG.set("preferences.zip_incremental" , self.zip_incremental)
         CONFIG.set("preferences.nameus" , self.nameus)
         CONFIG.set("preferences.anychar" , self.anychar)
         CONFIG.set("preferences.citattr" , self.citattr)
         CONFIG.set("preferences.placenote" , self.placenote)
+        CONFIG.set("preferences.record_cache" , self.use_record_cache)
+        CONFIG.set("preferences.deterministic" , self.deterministic)
+        CONFIG.set("preferences.record_index" , self.record_index)
+        CONFIG.set("preferences.filter_cache" , self.use_filter_cache)
+        CONFIG.set("preferences.branch_roots" , self.branch_roots)
+        CONFIG.set("preferences.branch_direction" , self.branch_direction)
+        CONFIG.set("preferences.branch_generations" , self.branch_generations)
         CONFIG.save()
 
-def export_data(database, filename, user, option_box=None):
+    def get_filtered_database(self, dbase, progress=None, preview=False):
+        """
+        Apply the proxies chosen to the dbase, and return.
+        """
+        self._tree_content = None
+        return super(GedcomWriterOptionBox, self).get_filtered_database(
+            dbase, progress, preview)
+
+    def apply_proxy(self, proxy_name, dbase, progress=None):
+        """
+        Apply the named proxy to the dbase, and return. With the
+        experimental bulk_living, the living people are found once for the
+        whole tree, when this version of Gramps allows it. With
+        filter_cache, the handles left by the person and note filters are
+        kept on disk, and reused while the tree, the filters and the other
+        options do not change.
+        """
+        key = self._filter_cache_key(proxy_name, dbase)
+        if key is not None:
+            cache = FilterCache(FILTER_CACHE)
+            try:
+                sets = cache.get(key)
+                if sets is not None:
+                    LOG.info("%s filter: %d people reused", proxy_name,
+                             len(sets["plist"]))
+                    if progress:
+                        progress.progress_cnt += 1
+                    return CachedFilterProxyDb(dbase, sets)
+                proxy = super(GedcomWriterOptionBox, self).apply_proxy(
+                    proxy_name, dbase, progress)
+                cache.set(key, filter_sets(proxy))
+                return proxy
+            finally:
+                cache.close()
+        proxy = super(GedcomWriterOptionBox, self).apply_proxy(
+            proxy_name, dbase, progress)
+        if proxy_name == "living" and proxy is not dbase and self.bulk_living:
+            if not BULK_LIVING_SUPPORTED:
+                LOG.warning("living: bulk determination not supported by "
+                            "this Gramps, LivingProxyDb used")
+                return proxy
+            LOG.warning("living: experimental bulk determination, not "
+                        "verified against probably_alive")
+            start = time.time()
+            current_year = None
+            if proxy.current_date is not None:
+                current_year = proxy.current_date.get_year()
+            proxy = BulkLivingProxyDb(dbase, proxy.mode, current_year,
+                                      proxy.years_after_death)
+            LOG.info("living: %d people in %.2fs", len(proxy.living),
+                     time.time() - start)
+        return proxy
+
+    def _filter_cache_key(self, proxy_name, dbase):
+        """
+        Key of the result of a person or note filter in the filter cache:
+        the tree and its content, the day (for the living people), the
+        filters and the other options. None when not cached.
+        """
+        if not self.use_filter_cache:
+            return None
+        if proxy_name == "person":
+            gfilter = filter_key(self.cfilter)
+        elif proxy_name == "note":
+            gfilter = filter_key(self.nfilter)
+        else:
+            return None
+        if gfilter is None:
+            return None
+        base = dbase.basedb if isinstance(dbase, ProxyDbBase) else dbase
+        if self._tree_content is None or self._tree_content[0] is not base:
+            self._tree_content = (base, content_stamp(base))
+        if self._tree_content[1] is None:
+            return None
+        return (FILTER_CACHE_VERSION, VERSION, base.get_dbid(),
+                self._tree_content[1], time.strftime("%Y-%m-%d"),
+                proxy_name, gfilter,
+                tuple(self.get_proxy_names()), self.private,
+                self.restrict_num, self.reference_num,
+                filter_key(self.cfilter), filter_key(self.nfilter),
+                self.bulk_living and BULK_LIVING_SUPPORTED,
+                config.get("behavior.max-age-prob-alive"),
+                config.get("behavior.max-sib-age-diff"),
+                config.get("behavior.avg-generation-gap"))
+
+    def mark_dirty(self, widget=None):
+        """
+        The filter settings changed: stop the preview being calculated.
+        """
+        self._cancel_preview()
+        super(GedcomWriterOptionBox, self).mark_dirty(widget)
+
+    def preview(self, widget):
+        """
+        Calculate the previews without blocking the dialog.
+
+        The counts already calculated for the same tree, unchanged, and the
+        same filter settings are shown at once. Otherwise the proxies are
+        applied and their people counted from GLib idle callbacks, each
+        count being shown as it goes: the person and note filters are
+        evaluated, the references followed and the people counted,
+        PREVIEW_SLICE objects at a time. The privacy and living proxies,
+        which decide when asked, are applied in one step. Changing a
+        setting or closing the dialog stops it.
+        """
+        self.parse_options()
+        self._cancel_preview()
+        self._tree_content = None
+        self.preview_button.set_sensitive(0)
+        self.proxy_dbase.clear()
+        key = self._preview_key()
+        counts = _PREVIEW_COUNTS.get(key)
+        if counts is not None:
+            for (proxy_name, count) in counts:
+                self._show_preview_count(proxy_name, count)
+            return
+        job = self._preview_steps(key)
+        self._preview_job = (job, GLib.idle_add(self._preview_step, job))
+
+    def _preview_key(self):
+        """
+        Key of the preview counts: the tree, its changes and the settings.
+        """
+        return (tree_stamp(self.dbstate), tuple(self.get_proxy_names()),
+                self.private, self.restrict_num, self.reference_num,
+                filter_key(self.cfilter), filter_key(self.nfilter),
+                self.bulk_living and BULK_LIVING_SUPPORTED)
+
+    def _preview_steps(self, key):
+        """
+        Generator calculating the previews, one step per iteration.
+        """
+        dbase = self.dbstate.db
+        counts = []
+        for proxy_name in self.get_proxy_names():
+            if proxy_name == "person" and filter_key(self.cfilter):
+                dbase = yield from self._filter_steps(proxy_name, dbase)
+            elif proxy_name == "note" and filter_key(self.nfilter):
+                dbase = yield from self._filter_steps(proxy_name, dbase)
+            elif proxy_name == "reference" and self.reference_num == 1:
+                dbase = SteppedReferencedProxyDb(dbase)
+                yield from dbase.steps(PREVIEW_SLICE)
+            else:
+                dbase = self.apply_proxy(proxy_name, dbase)
+            self.proxy_dbase[proxy_name] = dbase
+            yield
+            if isinstance(dbase, CachedFilterProxyDb):
+                count = len(dbase.plist)
+            else:
+                count = 0
+                for handle in dbase.iter_person_handles():
+                    count += 1
+                    if count % PREVIEW_SLICE == 0:
+                        self._show_preview_count(proxy_name, count, False)
+                        yield
+            self._show_preview_count(proxy_name, count)
+            counts.append((proxy_name, count))
+        self.preview_dbase = dbase
+        _PREVIEW_COUNTS[key] = counts
+
+    def _filter_steps(self, proxy_name, dbase):
+        """
+        Generator applying the person or note filter to PREVIEW_SLICE
+        objects per step, showing the number of people found so far.
+        Return the same selection as the FilterProxyDb of apply_proxy, as
+        a CachedFilterProxyDb, which is also kept in the filter cache.
+        """
+        key = self._filter_cache_key(proxy_name, dbase)
+        if key is not None:
+            cache = FilterCache(FILTER_CACHE)
+            try:
+                sets = cache.get(key)
+            finally:
+                cache.close()
+            if sets is not None:
+                return CachedFilterProxyDb(dbase, sets)
+        if proxy_name == "person":
+            gfilter = self.cfilter
+            handles = list(dbase.iter_person_handles())
+        else:
+            gfilter = self.nfilter
+            handles = list(dbase.iter_note_handles())
+        check = gfilter.get_check_func()
+        selected = set()
+        for rule in gfilter.flist:
+            rule.requestprepare(dbase, None)
+        try:
+            for start in range(0, len(handles), PREVIEW_SLICE):
+                selected.update(check(dbase,
+                                      handles[start:start + PREVIEW_SLICE]))
+                if proxy_name == "person":
+                    self._show_preview_count(proxy_name, len(selected), False)
+                yield
+        finally:
+            for rule in gfilter.flist:
+                rule.requestreset()
+        if proxy_name == "person":
+            people = selected
+            notes = set(dbase.iter_note_handles())
+        else:
+            people = set(dbase.iter_person_handles())
+            notes = selected
+        # the families of the people, as FilterProxyDb keeps them
+        families = set()
+        for (num, handle) in enumerate(people, 1):
+            person = dbase.get_person_from_handle(handle)
+            if person:
+                families.update(person.get_family_handle_list())
+                families.update(person.get_parent_family_handle_list())
+            if num % PREVIEW_SLICE == 0:
+                yield
+        sets = {
+            "plist" : people,
+            "flist" : families,
+            "elist" : set(dbase.iter_event_handles()),
+            "nlist" : notes,
+            }
+        if key is not None:
+            cache = FilterCache(FILTER_CACHE)
+            try:
+                cache.set(key, sets)
+            finally:
+                cache.close()
+        return CachedFilterProxyDb(dbase, sets)
+
+    def _preview_step(self, job):
+        """
+        GLib idle callback: run one step of the preview.
+        """
+        try:
+            next(job)
+            return True
+        except StopIteration:
+            self._preview_job = None
+            return False
+
+    def _cancel_preview(self, widget=None):
+        """
+        Stop the preview being calculated, if any.
+        """
+        if self._preview_job is not None:
+            (job, source) = self._preview_job
+            GLib.source_remove(source)
+            job.close()
+            self._preview_job = None
+
+    def _show_preview_count(self, proxy_name, count, done=True):
+        """
+        Show the number of people of a proxy, a partial one while counting.
+        """
+        button = self.preview_proxy_button[proxy_name]
+        button.set_sensitive(done)
+        # translators: leave all/any {...} untranslated
+        label = ngettext("{number_of} Person", "{number_of} People",
+                         count).format(number_of=count)
+        button.set_label(label if done else label + "\u2026")
+
+    def show_preview_data(self, widget):
+        """
+        Show the people of a preview, applying the proxies if the count
+        came from a previous preview.
+        """
+        if (widget.proxy_name != "unfiltered" and
+                widget.proxy_name not in self.proxy_dbase):
+            dbase = self.dbstate.db
+            for proxy_name in self.get_proxy_names():
+                dbase = self.apply_proxy(proxy_name, dbase)
+                self.proxy_dbase[proxy_name] = dbase
+                if proxy_name == widget.proxy_name:
+                    break
+        super(GedcomWriterOptionBox, self).show_preview_data(widget)
+
+def export_data(database, filename, user, option_box=None,
+                writer=GedcomWriterforGeneanet):
     """
     External interface used to register with the plugin system.
     """
     ret = False
     try:
-        ged_write = GedcomWriterforGeneanet(database, user, option_box)
+        ged_write = writer(database, user, option_box)
 #pylint: disable=maybe-no-member
         ret = ged_write.write_gedcom_file(filename)
     except IOError as msg:
@@ -1102,3 +2424,10 @@ def export_data(database, filename, user, option_box=None):
     except DatabaseError as msg:
         user.notify_db_error(_("Export failed"), msg)
     return ret
+
+def export_delta(database, filename, user, option_box=None):
+    """
+    External interface of the delta export.
+    """
+    return export_data(database, filename, user, option_box,
+                       GedcomDeltaWriterforGeneanet)
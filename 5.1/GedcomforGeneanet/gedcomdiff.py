@@ -0,0 +1,300 @@
+#!/usr/bin/env python3
+#
+# Gramps - a GTK+/GNOME based genealogy program
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+
+# $Id: $
+
+"""
+Record-level difference between two GEDCOM exports.
+
+    python3 gedcomdiff.py [--brief] [--ignore-header] [--natural] [-U N]
+                          OLD.ged NEW.ged
+
+Both files are memory-mapped and split into level 0 records, using the
+index written with the export (<file>.idx) when it matches the file; the
+index is checked once and read a line at a time. The records of two
+exports of this plugin come in the same order (sections, then IDs, in
+natural order with --natural), so they are compared in a single merge
+pass holding two records at a time. The order of both files is checked
+first: files in another order are compared by xref instead, keeping the
+offset and hash of each old record in a temporary SQLite file.
+
+Added, removed and modified records are reported, the modified ones with
+a unified diff of their lines. The exit status is 0 without differences,
+1 with differences and 2 with an index that does not cover its file, as
+for diff.
+"""
+#-------------------------------------------------------------------------
+#
+# Standard Python Modules
+#
+#-------------------------------------------------------------------------
+import argparse
+import difflib
+import hashlib
+import mmap
+import os
+import sqlite3
+import sys
+
+from libgeneanet import iter_record_index, natural_key, record_index_matches
+
+# Order of the sections of an export.
+SECTIONS = {
+    "HEAD" : 0, "SUBM" : 1, "INDI" : 2, "FAM" : 3, "SOUR" : 4,
+    "REPO" : 5, "NOTE" : 6, "OBJE" : 7, "TRLR" : 9,
+    }
+
+class OutOfOrder(Exception):
+    """
+    Records not in the order of an export of this plugin.
+    """
+
+def record_source(data, path):
+    """
+    Return a function yielding the (xref or tag, offset, length) of the
+    level 0 records of the mapped file data in one pass, each time it is
+    called: read from the index of path when it matches data, which is
+    checked here once, else found in data.
+    """
+    index = path + ".idx"
+    if record_index_matches(index, data):
+        return lambda: iter_record_index(index, len(data))
+    return lambda: split_records(data)
+
+def split_records(data):
+    """
+    Yield the (xref or tag, offset, length) of the level 0 records of the
+    mapped file data.
+    """
+    size = len(data)
+    start = 3 if data[:3] == b"\xef\xbb\xbf" else 0
+    if data[start:start + 2] != b"0 ":
+        start = data.find(b"\n0 ", start) + 1
+        if start == 0:
+            return
+    while start < size:
+        end = data.find(b"\n0 ", start)
+        end = size if end < 0 else end + 1
+        line_end = data.find(b"\n", start, end)
+        fields = data[start:end if line_end < 0 else line_end].split()
+        token = fields[1].decode('utf-8') if len(fields) > 1 else ""
+        yield (token, start, end - start)
+        start = end
+
+def record_key(data, token, offset, natural=False):
+    """
+    Sort key of a record in an export: its section, then its ID.
+    """
+    if token.startswith("@"):
+        line_end = data.find(b"\n", offset)
+        fields = data[offset:line_end].split()
+        tag = fields[2].decode('utf-8') if len(fields) > 2 else ""
+        if natural:
+            return (SECTIONS.get(tag, 8), natural_key(token.strip("@")))
+        return (SECTIONS.get(tag, 8), token.strip("@"))
+    if natural:
+        return (SECTIONS.get(token, 8), natural_key(token))
+    return (SECTIONS.get(token, 8), token)
+
+def keyed(data, records, natural=False):
+    """
+    Yield (key, token, offset, length), checking that keys increase.
+    """
+    previous = None
+    for (token, offset, length) in records:
+        key = record_key(data, token, offset, natural)
+        if previous is not None and key <= previous:
+            raise OutOfOrder(token)
+        previous = key
+        yield (key, token, offset, length)
+
+def in_order(data, records, natural=False):
+    """
+    Tell whether the records are in the order of an export.
+    """
+    try:
+        for _record in keyed(data, records, natural):
+            pass
+    except OutOfOrder:
+        return False
+    return True
+
+def digest(data, offset, length):
+    """
+    Hash of a record.
+    """
+    return hashlib.sha1(data[offset:offset + length]).digest()
+
+class RecordDiff(object):
+    """
+    Report of the differences between the records of two mapped files.
+    """
+    def __init__(self, old, new, names, out, brief=False, context=3,
+                 ignore=(), natural=False):
+        self.old = old
+        self.new = new
+        self.names = names
+        self.out = out
+        self.brief = brief
+        self.context = context
+        self.ignore = ignore
+        self.natural = natural
+        self.counts = {"added" : 0, "removed" : 0, "modified" : 0}
+
+    def added(self, token, offset, length):
+        """
+        Report a record only in the new file.
+        """
+        if token in self.ignore:
+            return
+        self.counts["added"] += 1
+        self.out.write("added %s\n" % token)
+
+    def removed(self, token, offset, length):
+        """
+        Report a record only in the old file.
+        """
+        if token in self.ignore:
+            return
+        self.counts["removed"] += 1
+        self.out.write("removed %s\n" % token)
+
+    def compare(self, token, old_offset, old_length, new_offset, new_length):
+        """
+        Report a record of both files if it changed, with its diff.
+        """
+        if token in self.ignore:
+            return
+        if (old_length == new_length and
+                self.old[old_offset:old_offset + old_length] ==
+                self.new[new_offset:new_offset + new_length]):
+            return
+        self.counts["modified"] += 1
+        self.out.write("modified %s\n" % token)
+        if self.brief:
+            return
+        old_lines = self.old[old_offset:old_offset + old_length].decode(
+            'utf-8', 'replace').splitlines(True)
+        new_lines = self.new[new_offset:new_offset + new_length].decode(
+            'utf-8', 'replace').splitlines(True)
+        for line in difflib.unified_diff(
+                old_lines, new_lines, "%s %s" % (self.names[0], token),
+                "%s %s" % (self.names[1], token), n=self.context):
+            self.out.write(line if line.endswith("\n") else line + "\n")
+
+    def merge(self, old_records, new_records):
+        """
+        Single pass over two exports in the same record order.
+        """
+        old_records = keyed(self.old, old_records, self.natural)
+        new_records = keyed(self.new, new_records, self.natural)
+        old_record = next(old_records, None)
+        new_record = next(new_records, None)
+        while old_record is not None or new_record is not None:
+            if new_record is None or (old_record is not None and
+                                      old_record[0] < new_record[0]):
+                self.removed(*old_record[1:])
+                old_record = next(old_records, None)
+            elif old_record is None or new_record[0] < old_record[0]:
+                self.added(*new_record[1:])
+                new_record = next(new_records, None)
+            else:
+                self.compare(old_record[1], old_record[2], old_record[3],
+                             new_record[2], new_record[3])
+                old_record = next(old_records, None)
+                new_record = next(new_records, None)
+
+    def by_xref(self, old_records, new_records):
+        """
+        Comparison of files in any order. The offset and hash of each old
+        record are kept in a temporary SQLite file, removed when closed,
+        rather than in memory.
+        """
+        connection = sqlite3.connect("")
+        try:
+            connection.execute(
+                "CREATE TABLE old (token TEXT PRIMARY KEY, offset INTEGER, "
+                "length INTEGER, digest BLOB, seen INTEGER)")
+            connection.executemany(
+                "INSERT OR REPLACE INTO old VALUES (?, ?, ?, ?, 0)",
+                ((token, offset, length, digest(self.old, offset, length))
+                 for (token, offset, length) in old_records))
+            for (token, offset, length) in new_records:
+                entry = connection.execute(
+                    "SELECT offset, length, digest FROM old "
+                    "WHERE token = ? AND seen = 0", (token,)).fetchone()
+                if entry is None:
+                    self.added(token, offset, length)
+                    continue
+                connection.execute(
+                    "UPDATE old SET seen = 1 WHERE token = ?", (token,))
+                if entry[2] != digest(self.new, offset, length):
+                    self.compare(token, entry[0], entry[1], offset, length)
+            for (token, offset, length) in connection.execute(
+                    "SELECT token, offset, length FROM old WHERE seen = 0 "
+                    "ORDER BY offset"):
+                self.removed(token, offset, length)
+        finally:
+            connection.close()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Record-level difference between two GEDCOM exports.")
+    parser.add_argument("old")
+    parser.add_argument("new")
+    parser.add_argument("--brief", action="store_true",
+                        help="only list the added, removed and modified xrefs")
+    parser.add_argument("--ignore-header", action="store_true",
+                        help="do not compare the HEAD records")
+    parser.add_argument("--natural", action="store_true",
+                        help="exports written with natural_order")
+    parser.add_argument("-U", "--unified", type=int, default=3,
+                        help="lines of context of the diffs")
+    args = parser.parse_args(argv)
+
+    out = sys.stdout
+    with open(args.old, 'rb') as old_file, open(args.new, 'rb') as new_file:
+        if os.path.getsize(args.old) == 0 or os.path.getsize(args.new) == 0:
+            old = old_file.read()
+            new = new_file.read()
+        else:
+            old = mmap.mmap(old_file.fileno(), 0, access=mmap.ACCESS_READ)
+            new = mmap.mmap(new_file.fileno(), 0, access=mmap.ACCESS_READ)
+        ignore = ("HEAD",) if args.ignore_header else ()
+        diff = RecordDiff(old, new, (args.old, args.new), out,
+                          args.brief, args.unified, ignore, args.natural)
+        old_records = record_source(old, args.old)
+        new_records = record_source(new, args.new)
+        try:
+            if (in_order(old, old_records(), args.natural) and
+                    in_order(new, new_records(), args.natural)):
+                diff.merge(old_records(), new_records())
+            else:
+                sys.stderr.write("records not in export order, comparing "
+                                 "by xref\n")
+                diff.by_xref(old_records(), new_records())
+        except ValueError as err:
+            sys.stderr.write("%s: %s\n" % (parser.prog, err))
+            return 2
+    out.write("%(added)d added, %(removed)d removed, %(modified)d modified\n"
+              % diff.counts)
+    return 1 if any(diff.counts.values()) else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,1296 @@
+#
+# Gramps - a GTK+/GNOME based genealogy program
+#
+# Copyright (C) 2012  Bastien Jacquet
+# Copyright (C) 2012  Doug Blank <doug.blank@gmail.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+
+# $Id: $
+
+"""
+Helpers of the GEDCOM for Geneanet export which do not depend on Gramps.
+"""
+#-------------------------------------------------------------------------
+#
+# Standard Python Modules
+#
+#-------------------------------------------------------------------------
+import hashlib
+import json
+import logging
+import os
+import re
+import sqlite3
+import struct
+import threading
+import time
+import zipfile
+import zlib
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+
+LOG = logging.getLogger("gedcomforgeneanet")
+
+# Encoded "<level> <TOKEN> " and "<level> <TOKEN>" prefixes, shared by
+# every emitter.
+_PREFIXES = {}
+_TAGS = {}
+
+# Characters a value must not be written with as is.
+_SPECIAL = re.compile('[\r\n@]')
+_NORMALIZE = re.compile('\n\r|\r|@')
+_FOLD = {'\n\r': '\n', '\r': '\n', '@': '@'}
+_FOLD_ANYCHAR = {'\n\r': '\n', '\r': '\n', '@': '@@'}
+
+# Start of a level 0 record and its xref or tag.
+_RECORD = re.compile(rb'^0 (\S+)', re.M)
+
+# Numbers in a Gramps ID.
+_DIGITS = re.compile(r'([0-9]+)')
+
+# Pointer to another record, "<level> <TAG> @<XREF>@", level 0 excluded.
+_POINTER = re.compile(rb'^[1-9][0-9]* [A-Z_0-9]+ @([^@\s]+)@', re.M)
+
+# In UTF-8: a position that starts a character str.isspace() rejects,
+# and one not after such a character.
+_BEFORE_NON_SPACE = (
+    rb'(?=[^\t-\r\x1c-\x20\x80-\xbf])(?!\xc2[\x85\xa0]|\xe1\x9a\x80|'
+    rb'\xe2\x80[\x80-\x8a\xa8\xa9\xaf]|\xe2\x81\x9f|\xe3\x80\x80)')
+_AFTER_NON_SPACE = (
+    rb'(?<![\t-\r\x1c-\x20])(?<!\xc2[\x85\xa0])(?<!\xe1\x9a\x80|'
+    rb'\xe2\x80[\x80-\x8a\xa8\xa9\xaf]|\xe2\x81\x9f|\xe3\x80\x80)')
+
+# Chunks of breakup, by limit.
+_CHUNKS = {}
+
+#-------------------------------------------------------------------------
+#
+# split_lines
+#
+#-------------------------------------------------------------------------
+def split_lines(text, anychar):
+    """
+    Return the list of lines a value is written as.
+
+    '\n\r' and '\r' are folded into '\n' and, when anychar is set, '@' is
+    doubled unless the value is an xref (starts with '@'), in a single
+    scan. Values without any of these characters come back unchanged.
+    """
+    if _SPECIAL.search(text) is None:
+        return [text]
+    if anychar and not text.startswith('@'):
+        fold = _FOLD_ANYCHAR
+    else:
+        fold = _FOLD
+    return _NORMALIZE.sub(lambda match: fold[match.group()], text).split('\n')
+
+#-------------------------------------------------------------------------
+#
+# breakup
+#
+#-------------------------------------------------------------------------
+def _chunks(limit):
+    """
+    Return the pattern of a chunk of at most limit UTF-8 bytes: the
+    longest one ending between two non-space characters, else the longest
+    one ending between two characters, else a character wider than limit.
+    """
+    pattern = _CHUNKS.get(limit)
+    if pattern is None:
+        pattern = re.compile(rb'.{1,%d}%s%s|.{1,%d}(?![\x80-\xbf])|'
+                             rb'[\xc0-\xff][\x80-\xbf]*' % (
+                                 limit, _BEFORE_NON_SPACE, _AFTER_NON_SPACE,
+                                 limit), re.S)
+        _CHUNKS[limit] = pattern
+    return pattern
+
+def _scan(txt, limit):
+    """
+    breakup of an ASCII text, a character a byte: scan back from limit
+    for the last position between two non-space characters.
+    """
+    data = []
+    start = 0
+    while len(txt) - start > limit:
+        end = start + limit
+        idx = end
+        while idx > start and (txt[idx - 1].isspace() or
+                               txt[idx].isspace()):
+            idx -= 1
+        if idx == start:
+            idx = end
+        data.append(txt[start:idx])
+        start = idx
+    data.append(txt[start:])
+    return data
+
+def breakup(txt, limit):
+    """
+    Break a line of text into a list of strings whose UTF-8 encoding does
+    not exceed limit bytes, breaking words in the middle to avoid issues
+    with spaces.
+
+    Each chunk ends at the last position between two non-space characters
+    that still fits, and the rest is kept whole once it fits. ASCII text
+    is scanned as is; other text is encoded once and cut by a single
+    regular expression on its bytes, which is faster than counting the
+    bytes of each character in Python.
+    """
+    if limit < 1:
+        raise ValueError("breakup: unexpected limit: %r" % limit)
+    if not txt:
+        return []
+    if len(txt) * 4 <= limit:
+        return [txt]
+    raw = txt.encode('utf-8')
+    if len(raw) <= limit:
+        return [txt]
+    if len(raw) == len(txt):
+        return _scan(txt, limit)
+    data = _chunks(limit).findall(raw)
+    # the chunks cut in the part that fits are joined again
+    first = len(data)
+    rest = 0
+    while rest + len(data[first - 1]) <= limit:
+        first -= 1
+        rest += len(data[first])
+    if first < len(data) - 1:
+        data[first:] = [b''.join(data[first:])]
+    if b'\n' in raw:
+        return [chunk.decode('utf-8') for chunk in data]
+    # decoded at once
+    return b'\n'.join(data).decode('utf-8').split('\n')
+
+def natural_key(text):
+    """
+    Sort key ordering the numbers in text by value: "I2" before "I10".
+    A tuple alternating text and numbers; the usual IDs, letters then a
+    number, skip the regular expression.
+    """
+    head = text.rstrip("0123456789")
+    if not head or head.isalpha():
+        tail = text[len(head):]
+        return (head, int(tail) if tail else -1, "")
+    parts = _DIGITS.split(text)
+    parts[1::2] = [int(number) for number in parts[1::2]]
+    return tuple(parts)
+
+#-------------------------------------------------------------------------
+#
+# ExportCache
+#
+#-------------------------------------------------------------------------
+class ExportCache(object):
+    """
+    Dictionary living for the duration of one export, counting its hits
+    and misses. None is never stored, it means the key is missing.
+    """
+    def __init__(self, name):
+        self.name = name
+        self.data = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """
+        Return the value cached for key, or None.
+        """
+        value = self.data.get(key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def set(self, key, value):
+        """
+        Cache value for key.
+        """
+        self.data[key] = value
+
+    def clear(self):
+        """
+        Drop every entry and reset the counters.
+        """
+        self.data.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def __str__(self):
+        return "%s: %d hits, %d misses, %d entries" % (
+            self.name, self.hits, self.misses, len(self.data))
+
+class LRUCache(ExportCache):
+    """
+    ExportCache holding at most size entries, the least recently used
+    ones being dropped first. A size of 0 means no limit.
+    """
+    def __init__(self, name, size):
+        ExportCache.__init__(self, name)
+        self.data = OrderedDict()
+        self.size = size
+        self.evictions = 0
+
+    def get(self, key):
+        """
+        Return the value cached for key, or None.
+        """
+        value = self.data.get(key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.data.move_to_end(key)
+        return value
+
+    def set(self, key, value):
+        """
+        Cache value for key, dropping the least recently used entry when
+        full.
+        """
+        self.data[key] = value
+        self.data.move_to_end(key)
+        if self.size and len(self.data) > self.size:
+            self.data.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self):
+        """
+        Drop every entry and reset the counters.
+        """
+        ExportCache.clear(self)
+        self.evictions = 0
+
+    def __str__(self):
+        return "%s, %d evictions" % (ExportCache.__str__(self),
+                                     self.evictions)
+
+#-------------------------------------------------------------------------
+#
+# GedcomEmitter
+#
+#-------------------------------------------------------------------------
+class GedcomEmitter(object):
+    """
+    Buffered emitter of UTF-8 encoded GEDCOM lines.
+
+    Lines are encoded into a reusable buffer which is handed to the
+    underlying binary file in large chunks. The line terminator is the
+    one the text layer would have used, so the output is byte-identical
+    to writing through io.open(..., encoding='utf-8').
+
+    With index, the offset of each level 0 record is recorded, and the
+    SHA-1 of the output computed, to be saved by write_index.
+    """
+    def __init__(self, fileobj, bufsize=1 << 20, eol=os.linesep, index=False):
+        self.fileobj = fileobj
+        self.bufsize = bufsize
+        self.eol = eol.encode('ascii')
+        self.buffer = bytearray()
+        self.written = 0
+        self.records = [] if index else None
+        self.sha1 = hashlib.sha1() if index else None
+
+    def line(self, level, token, text):
+        """
+        Emit "<level> <token> <text>".
+        """
+        if level == 0 and self.records is not None:
+            self.records.append((token, self.tell()))
+        prefix = _PREFIXES.get((level, token))
+        if prefix is None:
+            prefix = ("%d %s " % (level, token)).encode('utf-8')
+            _PREFIXES[(level, token)] = prefix
+        buf = self.buffer
+        buf += prefix
+        buf += text.encode('utf-8')
+        buf += self.eol
+        if len(buf) >= self.bufsize:
+            self.flush()
+
+    def tag(self, level, token):
+        """
+        Emit "<level> <token>" without any value.
+        """
+        if level == 0 and self.records is not None:
+            self.records.append((token, self.tell()))
+        prefix = _TAGS.get((level, token))
+        if prefix is None:
+            prefix = ("%d %s" % (level, token)).encode('utf-8')
+            _TAGS[(level, token)] = prefix
+        buf = self.buffer
+        buf += prefix
+        buf += self.eol
+        if len(buf) >= self.bufsize:
+            self.flush()
+
+    def write(self, text):
+        """
+        Emit raw text, translating newlines like the text layer does.
+        """
+        self.buffer += text.encode('utf-8').replace(b'\n', self.eol)
+        if len(self.buffer) >= self.bufsize:
+            self.flush()
+
+    def write_bytes(self, data):
+        """
+        Emit lines already encoded, e.g. rendered by another emitter.
+        """
+        if self.records is not None:
+            start = self.tell()
+            for match in _RECORD.finditer(data):
+                self.records.append((match.group(1).decode('utf-8'),
+                                     start + match.start()))
+        self.buffer += data
+        if len(self.buffer) >= self.bufsize:
+            self.flush()
+
+    def tell(self):
+        """
+        Return the number of bytes emitted so far.
+        """
+        return self.written + len(self.buffer)
+
+    def flush(self):
+        """
+        Hand the buffered lines to the underlying file.
+        """
+        if self.buffer:
+            if self.sha1 is not None:
+                self.sha1.update(self.buffer)
+            self.fileobj.write(self.buffer)
+            self.written += len(self.buffer)
+            del self.buffer[:]
+
+    def close(self):
+        """
+        Flush the buffer and close the underlying file.
+        """
+        self.flush()
+        self.fileobj.close()
+
+    def write_index(self, filename):
+        """
+        Save the index of the records emitted, see write_record_index.
+        """
+        self.flush()
+        write_record_index(filename, self.records, self.tell(),
+                           self.sha1.hexdigest())
+
+#-------------------------------------------------------------------------
+#
+# Record index
+#
+#-------------------------------------------------------------------------
+INDEX_MAGIC = "#gedcom-index 2"
+
+def write_record_index(filename, records, size, sha1):
+    """
+    Write the index of a GEDCOM file of size bytes and of the given SHA-1
+    whose level 0 records start at the given (xref or tag, offset), in
+    order.
+
+    The first line is INDEX_MAGIC, the size and the SHA-1 of the GEDCOM
+    file, which tell whether the index still matches it; then one line
+    per record: "<xref or tag> <offset> <length>".
+    """
+    with open(filename, 'w', encoding='utf-8') as fileobj:
+        fileobj.write("%s %d %s\n" % (INDEX_MAGIC, size, sha1))
+        for (position, (token, offset)) in enumerate(records):
+            if position + 1 < len(records):
+                end = records[position + 1][1]
+            else:
+                end = size
+            fileobj.write("%s %d %d\n" % (token, offset, end - offset))
+
+def record_index_matches(filename, data):
+    """
+    Tell whether filename is an index of the content data of a GEDCOM
+    file, by size and SHA-1. Only its first line is read.
+    """
+    try:
+        with open(filename, encoding='utf-8') as fileobj:
+            header = fileobj.readline().split()
+    except (IOError, ValueError):
+        return False
+    try:
+        return (" ".join(header[:2]) == INDEX_MAGIC and
+                int(header[2]) == len(data) and
+                header[3] == hashlib.sha1(data).hexdigest())
+    except (ValueError, IndexError):
+        return False
+
+def iter_record_index(filename, size):
+    """
+    Yield the (xref or tag, offset, length) of the records of an index,
+    reading it one line at a time. Raise ValueError when the records do
+    not cover the size bytes of the GEDCOM file one after the other.
+    """
+    end = None
+    with open(filename, encoding='utf-8') as fileobj:
+        fileobj.readline()
+        for line in fileobj:
+            try:
+                (token, offset, length) = line.split()
+                (offset, length) = (int(offset), int(length))
+            except ValueError:
+                raise ValueError("%s: unreadable line %r" % (filename, line))
+            if end is not None and offset != end:
+                raise ValueError("%s: record %s at %d, expected at %d" % (
+                    filename, token, offset, end))
+            end = offset + length
+            yield (token, offset, length)
+    if end is not None and end != size:
+        raise ValueError("%s: records end at %d, the file at %d" % (
+            filename, end, size))
+
+#-------------------------------------------------------------------------
+#
+# MediaArchive
+#
+#-------------------------------------------------------------------------
+# Compression of the media entries by MIME type: None stores the file as
+# is, a number is the deflate level. Formats which are already compressed
+# gain nearly nothing from deflate; uncompressed images, sound and text
+# often shrink by half or more. Other types use the archive level, which
+# stores them by default, as the export always did.
+COMPRESSION_POLICY = {
+    "image/bmp"    : 6,
+    "image/x-ms-bmp" : 6,
+    "image/tiff"   : 6,
+    "image/svg+xml" : 6,
+    "audio/wav"    : 6,
+    "audio/x-wav"  : 6,
+    "text/*"       : 6,
+    "image/jpeg"   : None,
+    "image/gif"    : None,
+    "image/png"    : None,
+    "image/webp"   : None,
+    "image/jp2"    : None,
+    "audio/mpeg"   : None,
+    "audio/ogg"    : None,
+    "video/*"      : None,
+    "application/zip" : None,
+    "application/gzip" : None,
+    "application/x-7z-compressed" : None,
+    }
+
+# Timestamp of the entries of a deterministic archive.
+FIXED_DATE_TIME = (1980, 1, 1, 0, 0, 0)
+
+# Version needed to extract an entry, and with ZIP64 extensions.
+ZIP_VERSION = 20
+ZIP64_VERSION = 45
+
+def parse_compression_policy(text):
+    """
+    Parse overrides of the compression policy written as
+    "image/tiff:9, image/png:store, video/*:store". Malformed items are
+    skipped with a warning.
+    """
+    policy = {}
+    for item in text.split(','):
+        if not item.strip():
+            continue
+        (mime, _sep, level) = item.rpartition(':')
+        mime = mime.strip()
+        level = level.strip().lower()
+        if level == "store" and mime:
+            policy[mime] = None
+        elif level.isdigit() and int(level) <= 9 and mime:
+            policy[mime] = int(level)
+        else:
+            LOG.warning("zip_policy: ignoring %r, expected "
+                        "<MIME type>:<0-9|store>", item.strip())
+    return policy
+
+def archive_name(path):
+    """
+    Return the name zipfile stores path under.
+    """
+    arcname = os.path.normpath(os.path.splitdrive(path)[1])
+    while arcname and arcname[0] in (os.sep, os.altsep):
+        arcname = arcname[1:]
+    return arcname.replace(os.sep, '/')
+
+def file_digest(path, blocksize=1 << 20):
+    """
+    Return (size, sha1) of the content of the file.
+    """
+    sha1 = hashlib.sha1()
+    size = 0
+    with open(path, 'rb') as fileobj:
+        block = fileobj.read(blocksize)
+        while block:
+            size += len(block)
+            sha1.update(block)
+            block = fileobj.read(blocksize)
+    return (size, sha1.hexdigest())
+
+def file_sha256(path, blocksize=1 << 20):
+    """
+    Return the SHA-256 of a file, in hexadecimal.
+    """
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as fileobj:
+        block = fileobj.read(blocksize)
+        while block:
+            sha256.update(block)
+            block = fileobj.read(blocksize)
+    return sha256.hexdigest()
+
+def replace_if_changed(path, target):
+    """
+    Move the file path to target unless target already has the same
+    content, in which case target, and its modification time, are left
+    alone. Files of the same size are compared by their SHA-256. The
+    SHA-256 of target is written to target + ".sha256", in the format of
+    sha256sum. Return True when target was replaced.
+    """
+    digest = file_sha256(path)
+    if (os.path.isfile(target) and
+            os.path.getsize(target) == os.path.getsize(path) and
+            file_sha256(target) == digest):
+        os.remove(path)
+        return False
+    os.replace(path, target)
+    with open(target + ".sha256", 'w', encoding='utf-8') as fileobj:
+        fileobj.write("%s  %s\n" % (digest, os.path.basename(target)))
+    return True
+
+def file_stamp(stat):
+    """
+    Return the comment recording the modification time of a media file
+    in its archive entry, or in the stamps file of a deterministic
+    archive.
+    """
+    return b"mtime_ns=%d" % stat.st_mtime_ns
+
+class MediaQueue(object):
+    """
+    Stand-in for MediaArchive recording the files to store, in order, so
+    that a record rendered aside can hand them to the real archive later.
+    """
+    def __init__(self):
+        self.items = []
+
+    def add(self, path, arcname, mime=None):
+        """
+        Record the file path of the given MIME type to be stored under
+        arcname.
+        """
+        self.items.append((path, arcname, mime))
+
+class _Claim(object):
+    """
+    First file seen with a given content, shared by the files having the
+    same content.
+    """
+    def __init__(self):
+        self.ready = threading.Event()
+        self.zinfo = None
+        self.data = None
+        self.cost = 0.0
+        self.stored = None
+        self.error = None
+
+class _Entry(object):
+    """
+    Archive entry prepared by a worker.
+
+    data is None when the entry is copied: from the previous archive
+    when reused is set, else from the file holding the same content,
+    claim.
+    """
+    __slots__ = ('zinfo', 'data', 'cost', 'claim', 'mime', 'reused')
+
+    def __init__(self, zinfo, data, cost, claim, mime, reused=None):
+        self.zinfo = zinfo
+        self.data = data
+        self.cost = cost
+        self.claim = claim
+        self.mime = mime
+        self.reused = reused
+
+class MediaArchive(object):
+    """
+    Zip archive of the exported media which stores each file once.
+
+    Files are queued while the GEDCOM is written. When the archive is
+    closed they are read, checksummed and compressed by a pool of worker
+    threads (zlib releases the GIL), and the finished entries are written
+    in the order of the queue by the closing thread.
+
+    References to an archive name already queued are skipped. With
+    dedupe_content, files are hashed and a file whose content is already
+    in the archive under another name is written from the data of the
+    first one instead of being compressed again.
+
+    Each file is stored or deflated according to its MIME type: the type,
+    then its "major/*" wildcard, is looked up in policy and then in
+    COMPRESSION_POLICY. Other files are deflated at compresslevel, or
+    stored when it is None.
+
+    With incremental, the archive found at filename is read first: the
+    entries of files whose size and modification time (and CRC, with
+    verify) did not change are copied as they are, without compressing
+    them again. Files no longer referenced are dropped. The new archive
+    replaces the old one when closed.
+
+    With deterministic, or incremental, every entry gets FIXED_DATE_TIME
+    and the same permissions, so the same files give the same archive
+    bytes. A deterministic archive only replaces the previous one if its
+    content changed, see replace_if_changed. Its modification times are
+    kept in filename + ".stamps" rather than in the entry comments.
+
+    The archive is laid out here rather than by zipfile.ZipFile, which has
+    no public API to add data already compressed: the local headers and
+    the central directory are written with the record formats of the zip
+    specification that the zipfile module exports.
+    """
+    def __init__(self, filename, dedupe_content=False, workers=1,
+                 compresslevel=None, policy=None, incremental=False,
+                 verify=False, deterministic=False):
+        self.filename = filename
+        self.previous = None
+        self.previous_entries = {}
+        self.previous_stamps = {}
+        self.stamps = {}
+        if incremental and zipfile.is_zipfile(filename):
+            with zipfile.ZipFile(filename) as previous:
+                self.previous_entries = dict(
+                    (zinfo.filename, zinfo)
+                    for zinfo in previous.infolist())
+            self.previous = open(filename, 'rb')
+            if deterministic:
+                self.previous_stamps = self.load_stamps(filename + ".stamps")
+        if incremental or deterministic:
+            self.target = filename + ".new"
+        else:
+            self.target = filename
+        self.fileobj = open(self.target, 'w+b')
+        self.entries = []
+        self.offset = 0
+        self.dedupe_content = dedupe_content
+        self.verify = verify
+        self.incremental = incremental
+        self.deterministic = deterministic
+        self.workers = max(1, workers)
+        self.compresslevel = compresslevel
+        self.policy = dict(COMPRESSION_POLICY)
+        self.policy.update(policy or {})
+        self.by_mime = {}
+        self.pending = []
+        self.references = {}
+        self._claims = {}
+        self._lock = threading.Lock()
+        self.stored = 0
+        self.reused = 0
+        self.skipped = 0
+        self.saved_bytes = 0
+        self.saved_time = 0.0
+        self.pack_time = 0.0
+
+    def level(self, mime):
+        """
+        Return the deflate level for the MIME type, None to store.
+        """
+        mime = mime or ""
+        if mime in self.policy:
+            return self.policy[mime]
+        wildcard = mime.split('/')[0] + "/*"
+        if wildcard in self.policy:
+            return self.policy[wildcard]
+        return self.compresslevel
+
+    def add(self, path, arcname, mime=None):
+        """
+        Queue the file path of the given MIME type to be stored under
+        arcname, unless already queued.
+        """
+        arcname = archive_name(arcname)
+        if arcname in self.references:
+            self.references[arcname] += 1
+            self.skipped += 1
+            return
+        self.references[arcname] = 1
+        self.pending.append((path, arcname, mime))
+
+    def _unchanged(self, old, path, stat, mime):
+        """
+        Tell whether the entry old of the previous archive still holds the
+        file path.
+        """
+        if self.deterministic:
+            stamp = self.previous_stamps.get(old.filename)
+        else:
+            stamp = old.comment
+        if old.file_size != stat.st_size or stamp != file_stamp(stat):
+            return False
+        if self.level(mime) is None:
+            if old.compress_type != zipfile.ZIP_STORED:
+                return False
+        elif old.compress_type != zipfile.ZIP_DEFLATED:
+            return False
+        if self.verify:
+            crc = 0
+            with open(path, 'rb') as fileobj:
+                block = fileobj.read(1 << 20)
+                while block:
+                    crc = zlib.crc32(block, crc)
+                    block = fileobj.read(1 << 20)
+            return crc == old.CRC
+        return True
+
+    def _prepare(self, path, arcname, mime):
+        """
+        Worker side: read, checksum and compress one file, or find it
+        unchanged in the previous archive. Return an _Entry.
+        """
+        start = time.time()
+        stat = os.stat(path)
+        zinfo = zipfile.ZipInfo.from_file(path, arcname)
+        if self.incremental and self.deterministic:
+            self.stamps[arcname] = file_stamp(stat)
+        elif self.incremental:
+            zinfo.comment = file_stamp(stat)
+        if self.incremental or self.deterministic:
+            zinfo.date_time = FIXED_DATE_TIME
+            zinfo.external_attr = 0o100644 << 16
+        old = self.previous_entries.get(arcname)
+        if old is not None and self._unchanged(old, path, stat, mime):
+            return _Entry(zinfo, None, time.time() - start, None, mime, old)
+        claim = None
+        if self.dedupe_content:
+            digest = file_digest(path)
+            with self._lock:
+                claim = self._claims.get(digest)
+                if claim is None:
+                    self._claims[digest] = _Claim()
+            if claim is not None:
+                # another file with the same content will be compressed
+                return _Entry(zinfo, None, time.time() - start, claim, mime)
+            claim = self._claims[digest]
+        try:
+            data = self._compress(path, zinfo, mime)
+            if claim is not None:
+                claim.zinfo = zinfo
+                claim.data = data
+                claim.cost = time.time() - start
+        except BaseException as err:
+            # the files waiting for this content must not wait forever
+            if claim is not None:
+                claim.error = err
+            raise
+        finally:
+            if claim is not None:
+                claim.ready.set()
+        return _Entry(zinfo, data, time.time() - start, claim, mime)
+
+    def _compress(self, path, zinfo, mime):
+        """
+        Read, checksum and compress the file path, filling zinfo. Return
+        the data as stored.
+        """
+        level = self.level(mime)
+        crc = 0
+        size = 0
+        chunks = []
+        if level is None:
+            compressor = None
+        else:
+            compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+        with open(path, 'rb') as fileobj:
+            block = fileobj.read(1 << 20)
+            while block:
+                size += len(block)
+                crc = zlib.crc32(block, crc)
+                if compressor:
+                    block = compressor.compress(block)
+                chunks.append(block)
+                block = fileobj.read(1 << 20)
+        if compressor:
+            chunks.append(compressor.flush())
+            zinfo.compress_type = zipfile.ZIP_DEFLATED
+        else:
+            zinfo.compress_type = zipfile.ZIP_STORED
+        data = b''.join(chunks)
+        zinfo.CRC = crc
+        zinfo.file_size = size
+        zinfo.compress_size = len(data)
+        return data
+
+    def _store(self, entry):
+        """
+        Writer side: append one prepared entry to the archive.
+        """
+        zinfo = entry.zinfo
+        data = entry.data
+        claim = entry.claim
+        if entry.reused is not None:
+            source = entry.reused
+            data = self.read_raw(source, self.previous)
+            self.reused += 1
+        elif data is None:
+            claim.ready.wait()
+            if claim.error is not None:
+                raise IOError("%s: the file with the same content could "
+                              "not be read: %s" % (zinfo.filename,
+                                                   claim.error))
+            source = claim.zinfo
+            if claim.stored is not None:
+                data = self.read_raw(claim.stored)
+            else:
+                data = claim.data
+            self.saved_bytes += source.file_size
+            self.saved_time += max(0.0, claim.cost - entry.cost)
+        else:
+            source = None
+            self.stored += 1
+            stats = self.by_mime.setdefault(entry.mime or "", [0, 0, 0, 0.0])
+            stats[0] += 1
+            stats[1] += zinfo.file_size
+            stats[2] += zinfo.compress_size
+            stats[3] += entry.cost
+        if source is not None:
+            zinfo.compress_type = source.compress_type
+            zinfo.CRC = source.CRC
+            zinfo.file_size = source.file_size
+            zinfo.compress_size = source.compress_size
+        self.write_raw(zinfo, data)
+        if claim is not None and claim.zinfo is zinfo:
+            claim.stored = zinfo
+            claim.data = None
+        references = self.references[zinfo.filename]
+        self.saved_bytes += (references - 1) * zinfo.file_size
+        self.saved_time += (references - 1) * entry.cost
+
+    def pack(self):
+        """
+        Compress the queued files on the worker threads and write them in
+        order. At most two entries per worker are kept in memory.
+        """
+        start = time.time()
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            window = deque()
+            for (path, arcname, mime) in self.pending:
+                window.append(pool.submit(self._prepare, path, arcname, mime))
+                if len(window) >= 2 * self.workers:
+                    self._store(window.popleft().result())
+            while window:
+                self._store(window.popleft().result())
+        self.pending = []
+        self.pack_time += time.time() - start
+
+    def read_raw(self, zinfo, fileobj=None):
+        """
+        Return the data of an entry as stored, read from fileobj, by
+        default the archive being written.
+        """
+        fileobj = fileobj or self.fileobj
+        fileobj.seek(zinfo.header_offset)
+        header = fileobj.read(zipfile.sizeFileHeader)
+        (name_len, extra_len) = struct.unpack('<HH', header[26:30])
+        fileobj.seek(zinfo.header_offset + zipfile.sizeFileHeader +
+                     name_len + extra_len)
+        return fileobj.read(zinfo.compress_size)
+
+    def write_raw(self, zinfo, data):
+        """
+        Append an entry whose data is already compressed, zinfo holding
+        its CRC and sizes, and keep it for the central directory.
+        """
+        (filename, flag_bits) = self._encoded_name(zinfo)
+        extra = b''
+        file_size = zinfo.file_size
+        compress_size = zinfo.compress_size
+        version = ZIP_VERSION
+        if max(file_size, compress_size) > zipfile.ZIP64_LIMIT:
+            extra = struct.pack('<HHQQ', 1, 16, file_size, compress_size)
+            file_size = compress_size = 0xffffffff
+            version = ZIP64_VERSION
+        (dosdate, dostime) = self._dos_date_time(zinfo)
+        zinfo.header_offset = self.offset
+        self.fileobj.seek(self.offset)
+        self.fileobj.write(struct.pack(
+            zipfile.structFileHeader, zipfile.stringFileHeader, version, 0,
+            flag_bits, zinfo.compress_type, dostime, dosdate, zinfo.CRC,
+            compress_size, file_size, len(filename), len(extra)))
+        self.fileobj.write(filename)
+        self.fileobj.write(extra)
+        self.fileobj.write(data)
+        self.offset = self.fileobj.tell()
+        self.entries.append(zinfo)
+
+    @staticmethod
+    def _encoded_name(zinfo):
+        """
+        Return the name of an entry as written and the flag bits telling
+        whether it is in UTF-8.
+        """
+        try:
+            return (zinfo.filename.encode('ascii'), 0)
+        except UnicodeEncodeError:
+            return (zinfo.filename.encode('utf-8'), 0x800)
+
+    @staticmethod
+    def _dos_date_time(zinfo):
+        """
+        Return the date and the time of an entry in the MS-DOS format.
+        """
+        (year, month, day, hour, minute, second) = zinfo.date_time
+        return ((year - 1980) << 9 | month << 5 | day,
+                hour << 11 | minute << 5 | second // 2)
+
+    def _write_central_directory(self):
+        """
+        Write the central directory of the entries and the end records,
+        with the ZIP64 ones when the sizes, offsets or count need them.
+        """
+        fileobj = self.fileobj
+        fileobj.seek(self.offset)
+        for zinfo in self.entries:
+            (filename, flag_bits) = self._encoded_name(zinfo)
+            file_size = zinfo.file_size
+            compress_size = zinfo.compress_size
+            header_offset = zinfo.header_offset
+            fields = []
+            if max(file_size, compress_size) > zipfile.ZIP64_LIMIT:
+                fields += [file_size, compress_size]
+                file_size = compress_size = 0xffffffff
+            if header_offset > zipfile.ZIP64_LIMIT:
+                fields.append(header_offset)
+                header_offset = 0xffffffff
+            extra = b''
+            version = ZIP_VERSION
+            if fields:
+                extra = struct.pack('<HH%dQ' % len(fields), 1,
+                                    8 * len(fields), *fields)
+                version = ZIP64_VERSION
+            (dosdate, dostime) = self._dos_date_time(zinfo)
+            fileobj.write(struct.pack(
+                zipfile.structCentralDir, zipfile.stringCentralDir, version,
+                zinfo.create_system, version, 0, flag_bits,
+                zinfo.compress_type, dostime, dosdate, zinfo.CRC,
+                compress_size, file_size, len(filename), len(extra),
+                len(zinfo.comment), 0, zinfo.internal_attr,
+                zinfo.external_attr, header_offset))
+            fileobj.write(filename)
+            fileobj.write(extra)
+            fileobj.write(zinfo.comment)
+        end = fileobj.tell()
+        count = len(self.entries)
+        size = end - self.offset
+        offset = self.offset
+        if (count > zipfile.ZIP_FILECOUNT_LIMIT or
+                size > zipfile.ZIP64_LIMIT or offset > zipfile.ZIP64_LIMIT):
+            fileobj.write(struct.pack(
+                zipfile.structEndArchive64, zipfile.stringEndArchive64, 44,
+                ZIP64_VERSION, ZIP64_VERSION, 0, 0, count, count, size,
+                offset))
+            fileobj.write(struct.pack(
+                zipfile.structEndArchive64Locator,
+                zipfile.stringEndArchive64Locator, 0, end, 1))
+            count = min(count, 0xffff)
+            size = min(size, 0xffffffff)
+            offset = min(offset, 0xffffffff)
+        fileobj.write(struct.pack(
+            zipfile.structEndArchive, zipfile.stringEndArchive, 0, 0, count,
+            count, size, offset, 0))
+        fileobj.truncate()
+
+    @staticmethod
+    def load_stamps(filename):
+        """
+        Return the modification times saved by save_stamps, {} when
+        missing or unreadable.
+        """
+        try:
+            with open(filename, encoding='utf-8') as fileobj:
+                return dict((arcname, stamp.encode('ascii'))
+                            for (arcname, stamp) in json.load(fileobj).items())
+        except (IOError, ValueError, AttributeError):
+            return {}
+
+    def save_stamps(self, filename):
+        """
+        Save the modification times of the files of the archive.
+        """
+        with open(filename, 'w', encoding='utf-8') as fileobj:
+            json.dump(dict((arcname, stamp.decode('ascii'))
+                           for (arcname, stamp) in self.stamps.items()),
+                      fileobj, sort_keys=True, indent=0)
+
+    def stats(self):
+        """
+        Return a one line summary of the archive.
+        """
+        return ("%d media stored in %.2fs by %d threads, %d reused from "
+                "the previous archive, %d dropped, %d duplicate references "
+                "skipped, %d bytes and %.2fs saved" % (
+                    self.stored, self.pack_time, self.workers, self.reused,
+                    len(set(self.previous_entries) - set(self.references)),
+                    self.skipped, self.saved_bytes, self.saved_time))
+
+    def mime_stats(self):
+        """
+        Return one summary line per MIME type: files, compression ratio
+        and time spent by the workers.
+        """
+        lines = []
+        for (mime, (count, size, compressed, cost)) in sorted(
+                self.by_mime.items()):
+            if self.level(mime) is None:
+                method = "stored"
+            else:
+                method = "deflated at %d" % self.level(mime)
+            lines.append("%s: %d files %s, %d -> %d bytes (%.1f%%), %.2fs" % (
+                mime or "unknown", count, method, size, compressed,
+                100.0 * compressed / size if size else 100.0, cost))
+        return lines
+
+    def close(self):
+        """
+        Pack the queued files, write the central directory and close the
+        archive, replacing the previous one in incremental mode.
+        """
+        try:
+            self.pack()
+            self._write_central_directory()
+        finally:
+            self.fileobj.close()
+            if self.previous is not None:
+                self.previous.close()
+        if self.deterministic:
+            replace_if_changed(self.target, self.filename)
+            if self.incremental:
+                self.save_stamps(self.filename + ".stamps")
+        elif self.target != self.filename:
+            os.replace(self.target, self.filename)
+
+#-------------------------------------------------------------------------
+#
+# RecordCache
+#
+#-------------------------------------------------------------------------
+class RecordCache(object):
+    """
+    On-disk cache of rendered GEDCOM records, kept in a SQLite file next to
+    the export.
+
+    Each record is stored under its handle with the keys of the objects
+    read to render it, a digest of their stamps, the encoded lines and the
+    medias to store in the zip. The caller recomputes the digest from the
+    current stamps to tell whether the record is still valid.
+
+    Records are stamped with the number of the export which last used
+    them. When the file grows over limit bytes, the least recently used
+    ones are evicted when the cache is closed.
+    """
+    def __init__(self, filename, limit):
+        self.filename = filename
+        self.limit = limit
+        self.connection = sqlite3.connect(filename)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS records (handle TEXT PRIMARY KEY, "
+            "deps TEXT, digest TEXT, data BLOB, medias TEXT, "
+            "used INTEGER, size INTEGER)")
+        self.connection.execute(
+            "CREATE INDEX IF NOT EXISTS records_used ON records (used)")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, "
+            "value TEXT)")
+        row = self.connection.execute(
+            "SELECT value FROM meta WHERE key = 'run'").fetchone()
+        self.run = int(row[0]) + 1 if row else 1
+        self.connection.execute(
+            "INSERT OR REPLACE INTO meta VALUES ('run', ?)", (str(self.run),))
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+
+    def lookup(self, handle):
+        """
+        Return (keys, digest) of the cached record, or None.
+        """
+        row = self.connection.execute(
+            "SELECT deps, digest FROM records WHERE handle = ?",
+            (handle,)).fetchone()
+        if row is None:
+            return None
+        return (json.loads(row[0]), row[1])
+
+    def fetch(self, handle):
+        """
+        Return (data, medias) of a cached record and mark it as used.
+        """
+        self.hits += 1
+        (data, medias) = self.connection.execute(
+            "SELECT data, medias FROM records WHERE handle = ?",
+            (handle,)).fetchone()
+        self.connection.execute(
+            "UPDATE records SET used = ? WHERE handle = ?", (self.run, handle))
+        return (bytes(data), [tuple(media) for media in json.loads(medias)])
+
+    def store(self, handle, keys, digest, data, medias):
+        """
+        Cache a rendered record.
+        """
+        self.misses += 1
+        self.connection.execute(
+            "INSERT OR REPLACE INTO records VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (handle, json.dumps(keys), digest, data, json.dumps(medias),
+             self.run, len(data)))
+
+    def evict(self):
+        """
+        Drop the least recently used records until the cache holds at most
+        limit bytes.
+        """
+        (total,) = self.connection.execute(
+            "SELECT TOTAL(size) FROM records").fetchone()
+        if total <= self.limit:
+            return
+        cursor = self.connection.execute(
+            "SELECT handle, size FROM records ORDER BY used")
+        dropped = []
+        for (handle, size) in cursor:
+            if total <= self.limit:
+                break
+            dropped.append((handle,))
+            total -= size
+        self.connection.executemany(
+            "DELETE FROM records WHERE handle = ?", dropped)
+        self.evicted += len(dropped)
+
+    def close(self):
+        """
+        Evict the records over the size limit and save the cache.
+        """
+        self.evict()
+        self.connection.commit()
+        if self.evicted:
+            self.connection.execute("VACUUM")
+        self.connection.close()
+
+    def __str__(self):
+        return "record cache: %d records reused, %d rendered, %d evicted" % (
+            self.hits, self.misses, self.evicted)
+
+#-------------------------------------------------------------------------
+#
+# FilterCache
+#
+#-------------------------------------------------------------------------
+class FilterCache(object):
+    """
+    On-disk cache of the handle sets left by the export filters, in a
+    SQLite file.
+
+    Each result is stored under a digest of its key, i.e. of everything
+    it depends on, as a dictionary of named sets of handles. Only the
+    entries most recently used are kept.
+    """
+    def __init__(self, filename, entries=16):
+        self.filename = filename
+        self.entries = entries
+        self.connection = sqlite3.connect(filename)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS filters (key TEXT PRIMARY KEY, "
+            "data BLOB, used REAL)")
+
+    @staticmethod
+    def digest(key):
+        """
+        Digest of a key, a tuple of strings, numbers and tuples.
+        """
+        return hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        """
+        Return the sets cached under key, or None.
+        """
+        digest = self.digest(key)
+        row = self.connection.execute(
+            "SELECT data FROM filters WHERE key = ?", (digest,)).fetchone()
+        if row is None:
+            return None
+        self.connection.execute(
+            "UPDATE filters SET used = ? WHERE key = ?", (time.time(), digest))
+        self.connection.commit()
+        return dict((name, set(handles)) for (name, handles) in
+                    json.loads(zlib.decompress(row[0]).decode('utf-8')).items())
+
+    def set(self, key, sets):
+        """
+        Cache the sets of handles, name -> set, under key, dropping the
+        entries least recently used over the limit.
+        """
+        data = zlib.compress(json.dumps(
+            dict((name, sorted(handles)) for (name, handles) in sets.items()),
+            separators=(',', ':')).encode('utf-8'))
+        self.connection.execute(
+            "INSERT OR REPLACE INTO filters VALUES (?, ?, ?)",
+            (self.digest(key), data, time.time()))
+        self.connection.execute(
+            "DELETE FROM filters WHERE key NOT IN (SELECT key FROM filters "
+            "ORDER BY used DESC LIMIT ?)", (self.entries,))
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+
+#-------------------------------------------------------------------------
+#
+# Delta manifest
+#
+#-------------------------------------------------------------------------
+MANIFEST_VERSION = 1
+
+def referenced_ids(data):
+    """
+    Return the IDs of the records pointed to by encoded GEDCOM lines.
+    """
+    return set(xref.decode('utf-8') for xref in _POINTER.findall(data))
+
+def load_manifest(filename, options):
+    """
+    Return the records of the manifest of the previous delta export:
+    handle -> [kind, gramps_id, keys, digest, content hash]. The manifest
+    is ignored, i.e. everything is exported again, when missing or written
+    with other options.
+    """
+    try:
+        with open(filename, encoding='utf-8') as fileobj:
+            manifest = json.load(fileobj)
+    except (IOError, ValueError):
+        return {}
+    if (manifest.get("version") != MANIFEST_VERSION or
+            manifest.get("options") != options):
+        return {}
+    return manifest["records"]
+
+def save_manifest(filename, options, records):
+    """
+    Write the manifest of a delta export, replacing the previous one only
+    once complete.
+    """
+    with open(filename + ".tmp", 'w', encoding='utf-8') as fileobj:
+        json.dump({"version" : MANIFEST_VERSION, "options" : options,
+                   "records" : records}, fileobj, separators=(',', ':'),
+                  sort_keys=True)
+    os.replace(filename + ".tmp", filename)
@@ -0,0 +1,793 @@
+#
+# Gramps - a GTK+/GNOME based genealogy program
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+
+# $Id: $
+
+"""
+Bulk reads of a Gramps database for the GEDCOM for Geneanet export.
+
+The SQL backends (DB-API) are read with a few set-based queries on their
+tables, BSDDB with a single scan of its cursors. The functions return
+None on other backends, the caller then going through the objects.
+They take the database itself, not a proxy: filters are applied by the
+caller.
+
+MaterializedDb evaluates a chain of filters once, for any backend.
+LivingEngine decides who is probably alive for a whole tree at once
+(experimental, not yet checked against probably_alive on real trees).
+CachedFilterProxyDb replays the saved result of the filters.
+SteppedReferencedProxyDb follows the references a few objects at a time.
+KinshipIndex selects the ancestors and descendants of some people.
+"""
+#-------------------------------------------------------------------------
+#
+# Standard Python Modules
+#
+#-------------------------------------------------------------------------
+import hashlib
+import pickle
+from collections import deque
+
+#-------------------------------------------------------------------------
+#
+# Gramps modules
+#
+#-------------------------------------------------------------------------
+from gramps.gen.db.dbconst import CLASS_TO_KEY_MAP, KEY_TO_CLASS_MAP
+from gramps.gen.lib.date import Date, Today
+from gramps.gen.proxy.filter import FilterProxyDb
+from gramps.gen.proxy.living import LivingProxyDb
+from gramps.gen.proxy.proxybase import ProxyDbBase
+from gramps.gen.proxy.referencedbyselection import \
+    ReferencedBySelectionProxyDb
+from gramps.gen.utils.alive import ProbablyAlive
+
+# Types of objects kept by MaterializedDb, and their iterator
+MATERIALIZED_KINDS = (
+    ("person", "iter_people"),
+    ("family", "iter_families"),
+    ("event", "iter_events"),
+    ("place", "iter_places"),
+    ("source", "iter_sources"),
+    ("citation", "iter_citations"),
+    ("repository", "iter_repositories"),
+    ("media", "iter_media"),
+    ("note", "iter_notes"),
+    )
+
+# Tables of the objects of a tree
+OBJECT_TABLES = ("person", "family", "event", "place", "source", "citation",
+                 "media", "repository", "note", "tag")
+
+# Kinds of events, as LivingEngine keeps them
+BIRTH = 1
+DEATH = 2
+BIRTH_FALLBACK = 4
+DEATH_FALLBACK = 8
+
+def _text(handle):
+    """
+    Handles of the BSDDB cursors come as bytes.
+    """
+    return handle.decode('utf-8') if isinstance(handle, bytes) else handle
+
+def backend(dbase):
+    """
+    Return "dbapi", "bsddb" or None for the backend of a database.
+    """
+    if hasattr(dbase, "dbapi"):
+        return "dbapi"
+    if hasattr(dbase, "get_reference_map_cursor"):
+        return "bsddb"
+    return None
+
+def raw_gramps_ids(dbase, kind):
+    """
+    Return the (gramps_id, handle) of all the objects of a kind ("person",
+    "family", ...) of a database, read from the gramps_id column of the
+    SQL backends or else from the raw data of the cursor, without building
+    the objects.
+    """
+    if backend(dbase) == "dbapi":
+        dbase.dbapi.execute("SELECT gramps_id, handle FROM %s" % kind)
+        return [tuple(row) for row in dbase.dbapi.fetchall()]
+    with getattr(dbase, "get_%s_cursor" % kind)() as cursor:
+        return [(data[1], _text(handle)) for (handle, data) in cursor]
+
+# Position of the change time in the raw data of each type of object
+CHANGE_FIELDS = {
+    "person" : 17, "family" : 12, "event" : 10, "place" : 15,
+    "source" : 8, "citation" : 9, "media" : 9, "repository" : 7,
+    "note" : 5,
+    }
+
+def last_change(dbase):
+    """
+    Return the latest change time of the objects of a tree, tags aside,
+    read from the change column of the SQL backends or else from the raw
+    data of the cursors, without building the objects; or None on an
+    unknown backend.
+    """
+    kind = backend(dbase)
+    latest = 0
+    if kind == "dbapi":
+        for table in CHANGE_FIELDS:
+            dbase.dbapi.execute("SELECT MAX(change) FROM %s" % table)
+            latest = max(latest, dbase.dbapi.fetchone()[0] or 0)
+    elif kind == "bsddb":
+        for (table, field) in CHANGE_FIELDS.items():
+            with getattr(dbase, "get_%s_cursor" % table)() as cursor:
+                for (handle, data) in cursor:
+                    latest = max(latest, data[field])
+    else:
+        return None
+    return latest
+
+def content_stamp(dbase):
+    """
+    Return a digest of the content of a tree, which changes when objects
+    are added, edited or deleted; or None on an unknown backend. The
+    objects are not built.
+
+    With DB-API it is a digest of the handle and change time of every row
+    of each table, without reading the data: an object edited twice in
+    the same second is taken as unchanged. With BSDDB it is a digest of
+    the handle and raw data of every object.
+    """
+    sha1 = hashlib.sha1()
+    kind = backend(dbase)
+    if kind == "dbapi":
+        for table in OBJECT_TABLES:
+            sha1.update(table.encode('utf-8'))
+            dbase.dbapi.execute(
+                "SELECT handle, change FROM %s ORDER BY handle" % table)
+            row = dbase.dbapi.fetchone()
+            while row:
+                sha1.update(("%s %s\n" % tuple(row)).encode('utf-8'))
+                row = dbase.dbapi.fetchone()
+    elif kind == "bsddb":
+        for table in OBJECT_TABLES:
+            sha1.update(table.encode('utf-8'))
+            with getattr(dbase, "get_%s_cursor" % table)() as cursor:
+                for (handle, data) in cursor:
+                    sha1.update(_text(handle).encode('utf-8'))
+                    sha1.update(pickle.dumps(data, 2))
+    else:
+        return None
+    return sha1.hexdigest()
+
+def references_to(dbase, class_name):
+    """
+    Return the (handle, referrer class name, referrer handle) of the
+    references to the objects of a class ("Event", "Media", ...), or None
+    on an unknown backend.
+    """
+    kind = backend(dbase)
+    if kind == "dbapi":
+        dbase.dbapi.execute(
+            "SELECT ref_handle, obj_class, obj_handle FROM reference "
+            "WHERE ref_class = ?", [class_name])
+        return [tuple(row) for row in dbase.dbapi.fetchall()]
+    if kind == "bsddb":
+        ref_key = CLASS_TO_KEY_MAP[class_name]
+        references = []
+        with dbase.get_reference_map_cursor() as cursor:
+            for (key, data) in cursor:
+                if isinstance(data, bytes):
+                    data = pickle.loads(data)
+                ((obj_class, handle), (ref_class, ref_handle)) = data
+                if ref_class == ref_key:
+                    references.append((_text(ref_handle),
+                                       KEY_TO_CLASS_MAP[obj_class],
+                                       _text(handle)))
+        return references
+    return None
+
+def event_references(dbase):
+    """
+    Return the (event handle, person handle or None, family handle or
+    None) of the references of the people and families to the events, or
+    None on an unknown backend.
+    """
+    references = references_to(dbase, "Event")
+    if references is None:
+        return None
+    return [(event, handle if obj_class == "Person" else None,
+             handle if obj_class == "Family" else None)
+            for (event, obj_class, handle) in references
+            if obj_class in ("Person", "Family")]
+
+def shared_events(dbase):
+    """
+    Return the events referenced by a family or by several people, and
+    the people referencing them, as two sets of handles; or None on an
+    unknown backend.
+
+    Only these events can have witnesses other than the person writing
+    them, so only these people are needed for the witness lists.
+    """
+    references = event_references(dbase)
+    if references is None:
+        return None
+    people = {}
+    in_family = set()
+    for (event, person, family) in references:
+        if person is not None:
+            people.setdefault(event, set()).add(person)
+        else:
+            in_family.add(event)
+    events = set(event for (event, handles) in people.items()
+                 if len(handles) > 1 or event in in_family)
+    return (events, set(person for event in events
+                        for person in people[event]))
+
+#-------------------------------------------------------------------------
+#
+# MaterializedDb
+#
+#-------------------------------------------------------------------------
+class MaterializedDb(ProxyDbBase):
+    """
+    Flat view of a chain of proxies (privacy, living, person and note
+    filters, references), evaluated once: the handles the chain lets
+    through and the objects as it returns them, sanitized. Reading an
+    object then costs a dictionary lookup instead of a call through every
+    proxy.
+
+    Handles the chain does not list are still asked to it, once, so that
+    the view answers as the chain does.
+    """
+    def __init__(self, dbase, callback=None):
+        """
+        Evaluate the chain dbase. callback(kind, count) is called after
+        each type of objects.
+        """
+        ProxyDbBase.__init__(self, dbase)
+        self.handles = {}
+        self.objects = {}
+        for (kind, iterator) in MATERIALIZED_KINDS:
+            get_object = getattr(dbase, "get_%s_from_handle" % kind)
+            handles = list(getattr(dbase, "iter_%s_handles" % kind)())
+            self.handles[kind] = handles
+            self.objects[kind] = dict((handle, get_object(handle))
+                                      for handle in handles)
+            if callback:
+                callback(kind, len(handles))
+
+    def __str__(self):
+        return "materialized view: %s" % ", ".join(
+            "%d %s" % (len(self.handles[kind]), kind)
+            for (kind, iterator) in MATERIALIZED_KINDS)
+
+def _materialized_get(kind):
+    method = "get_%s_from_handle" % kind
+    def get_from_handle(self, handle):
+        objects = self.objects[kind]
+        try:
+            return objects[handle]
+        except KeyError:
+            obj = objects[handle] = getattr(self.db, method)(handle)
+            return obj
+    get_from_handle.__name__ = method
+    return get_from_handle
+
+def _materialized_handles(kind):
+    def iter_handles(self):
+        return iter(self.handles[kind])
+    iter_handles.__name__ = "iter_%s_handles" % kind
+    return iter_handles
+
+def _materialized_objects(kind, iterator):
+    def iter_objects(self):
+        objects = self.objects[kind]
+        return (objects[handle] for handle in self.handles[kind]
+                if objects[handle] is not None)
+    iter_objects.__name__ = iterator
+    return iter_objects
+
+def _materialized_include(kind):
+    def include(self, handle):
+        return self.objects[kind].get(handle) is not None
+    include.__name__ = "include_%s" % kind
+    return include
+
+for (_kind, _iterator) in MATERIALIZED_KINDS:
+    setattr(MaterializedDb, "get_%s_from_handle" % _kind,
+            _materialized_get(_kind))
+    setattr(MaterializedDb, "iter_%s_handles" % _kind,
+            _materialized_handles(_kind))
+    setattr(MaterializedDb, _iterator, _materialized_objects(_kind, _iterator))
+    setattr(MaterializedDb, "include_%s" % _kind, _materialized_include(_kind))
+
+#-------------------------------------------------------------------------
+#
+# CachedFilterProxyDb
+#
+#-------------------------------------------------------------------------
+# Sets of handles of a FilterProxyDb
+FILTER_SETS = ("plist", "flist", "elist", "nlist")
+
+class CachedFilterProxyDb(FilterProxyDb):
+    """
+    FilterProxyDb made of given sets of handles, name -> set, such as
+    those of a previous one, without evaluating filters.
+    """
+    def __init__(self, dbase, sets):
+        ProxyDbBase.__init__(self, dbase)
+        self.person_filter = None
+        for name in FILTER_SETS:
+            setattr(self, name, sets[name])
+
+def filter_sets(proxy):
+    """
+    Return the sets of handles of a FilterProxyDb, name -> set.
+    """
+    return dict((name, getattr(proxy, name)) for name in FILTER_SETS)
+
+#-------------------------------------------------------------------------
+#
+# SteppedReferencedProxyDb
+#
+#-------------------------------------------------------------------------
+class SteppedReferencedProxyDb(ReferencedBySelectionProxyDb):
+    """
+    ReferencedBySelectionProxyDb of all the people, whose references are
+    followed by iterating over steps() instead of in the constructor. It
+    must not be used before the steps are exhausted.
+    """
+    def __init__(self, dbase):
+        ProxyDbBase.__init__(self, dbase)
+        self.reset_references()
+        self.restricted_to = {"Person": None}
+        self.queue = []
+
+    def steps(self, size):
+        """
+        Generator following the references, size objects per iteration,
+        as ReferencedBySelectionProxyDb(dbase, all_people=True) does.
+        """
+        self.restricted_to["Person"] = list(self.db.iter_person_handles())
+        for handle in self.restricted_to["Person"]:
+            if handle:
+                self.queue_object("Person", handle)
+        count = 0
+        while self.queue:
+            (obj_type, handle, reference) = self.queue.pop()
+            self.process_object(obj_type, handle, reference)
+            count += 1
+            if count % size == 0:
+                yield
+
+#-------------------------------------------------------------------------
+#
+# LivingEngine
+#
+#-------------------------------------------------------------------------
+class LivingEngine(object):
+    """
+    The answer of probably_alive for every person of a tree, computed
+    together.
+
+    probably_alive looks for evidence in the person's events, then the
+    siblings, the spouses and the descendants, reading them anew for each
+    person. Here the events, people and families are read in one pass
+    each, into tables of what the search looks at, and the evidence found
+    for each family of siblings, each spouse and each line of descendants
+    is kept for the next people asking for it. The first evidence found,
+    in the same order, and the dates derived from it are the same as
+    probably_alive's.
+
+    As probably_alive_range marks the person visited by the search of
+    the descendants before searching the ancestors, the ancestors never
+    decide and are not searched.
+
+    Experimental: this is a rewrite of probably_alive, which decides whose
+    data is published, and its answers have not yet been compared with
+    probably_alive's on real trees (see bench/bench_living.py). It is only
+    used with preferences.experimental_bulk_living.
+    """
+    def __init__(self, dbase, basedb=None):
+        """
+        Read dbase, the tree or the proxy the people are judged through,
+        as probably_alive(person, dbase). As LivingProxyDb, the own events
+        and families of the person judged are those of the person in the
+        tree basedb, when given, the relatives those seen through dbase.
+        """
+        limits = ProbablyAlive(dbase)
+        self.max_sib_age_diff = limits.MAX_SIB_AGE_DIFF
+        self.max_age_prob_alive = limits.MAX_AGE_PROB_ALIVE
+        self.avg_generation_gap = limits.AVG_GENERATION_GAP
+        # event handle -> (kind, date)
+        self.events = {}
+        for event in dbase.iter_events():
+            etype = event.get_type()
+            kind = ((etype.is_birth() and BIRTH) |
+                    (etype.is_death() and DEATH) |
+                    (etype.is_birth_fallback() and BIRTH_FALLBACK) |
+                    (etype.is_death_fallback() and DEATH_FALLBACK))
+            self.events[event.get_handle()] = (kind, event.get_date_object())
+        # person handle -> (birth (handle, primary), death (handle,
+        # primary), primary events, parent families, families)
+        self.people = {}
+        for person in dbase.iter_people():
+            self.people[person.get_handle()] = self._person(person)
+        # the same for the people judged, unfiltered
+        self.own = self.people
+        if basedb is not None and basedb is not dbase:
+            self.own = {}
+            for person in basedb.iter_people():
+                if person.get_handle() in self.people:
+                    self.own[person.get_handle()] = self._person(person)
+        # family handle -> (father, mother, children, events)
+        self.families = {}
+        for family in dbase.iter_families():
+            self.families[family.get_handle()] = (
+                family.get_father_handle(), family.get_mother_handle(),
+                [ref.ref for ref in family.get_child_ref_list()],
+                [ref.ref for ref in family.get_event_ref_list()])
+        self.siblings = {}
+        self.spouses = {}
+        self.descendants = {}
+
+    @staticmethod
+    def _person(person):
+        """
+        The row of a person in the people table.
+        """
+        (birth, death) = (person.get_birth_ref(), person.get_death_ref())
+        return (birth and (birth.ref, birth.get_role().is_primary()),
+                death and (death.ref, death.get_role().is_primary()),
+                [ref.ref for ref in person.get_primary_event_ref_list()],
+                person.get_parent_family_handle_list(),
+                person.get_family_handle_list())
+
+    def living(self, current_date=None, limit=0):
+        """
+        Return the set of the handles of the people probably alive on
+        current_date (today by default), counting limit years after the
+        death, as probably_alive(person, dbase, current_date, limit).
+        """
+        if current_date is None:
+            current_date = Today()
+        alive = set()
+        for handle in self.people:
+            (birth, death) = self.alive_range(handle)
+            if not birth or not death:
+                alive.add(handle)
+                continue
+            if limit:
+                death += limit
+            if (current_date.match(birth, ">=") and
+                    current_date.match(death, "<=")):
+                alive.add(handle)
+        return alive
+
+    def alive_range(self, handle, is_spouse=False):
+        """
+        Return the estimated (birth, death) dates of a person, as
+        probably_alive_range, or (None, None) without evidence.
+        """
+        if is_spouse:
+            if handle not in self.spouses:
+                self.spouses[handle] = self._range(handle, True)
+            return self.spouses[handle]
+        return self._range(handle, False)
+
+    def _range(self, handle, is_spouse):
+        """
+        probably_alive_range over the tables.
+        """
+        person = (self.people if is_spouse else self.own).get(handle)
+        if person is None:
+            return (None, None)
+        (birth_ref, death_ref, primary, parents, families) = person
+        (birth_date, death_date) = (None, None)
+        if death_ref and death_ref[1]:
+            death = self.events.get(death_ref[0])
+            if death:
+                death_date = death[1]
+        if not death_date:
+            for event in self._events(primary):
+                if event[0] & DEATH_FALLBACK:
+                    death_date = event[1]
+                    if not death_date.is_valid():
+                        death_date = Today()
+                        death_date.set_modifier(Date.MOD_BEFORE)
+        if birth_ref and birth_ref[1]:
+            birth = self.events.get(birth_ref[0])
+            if birth and birth[1].get_start_date() != Date.EMPTY:
+                birth_date = birth[1]
+        if not birth_date:
+            for event in self._events(primary):
+                if event[0] & BIRTH_FALLBACK:
+                    birth_date = event[1]
+        if not birth_date and death_date:
+            if death_date.is_valid():
+                birth_date = death_date.copy_offset_ymd(
+                    year=-self.max_age_prob_alive)
+            else:
+                birth_date = death_date
+        if not death_date and birth_date:
+            death_date = birth_date.copy_offset_ymd(
+                year=self.max_age_prob_alive)
+        if death_date and birth_date:
+            return (birth_date, death_date)
+
+        for family_handle in parents:
+            if family_handle not in self.siblings:
+                self.siblings[family_handle] = self._siblings(family_handle)
+            if self.siblings[family_handle]:
+                return self.siblings[family_handle]
+
+        if not is_spouse:
+            found = self._spouses(handle, families)
+            if found:
+                return found
+
+        found = self._descendants(handle)
+        if found:
+            (kind, dobj, depth) = found
+            if kind == BIRTH:
+                date = Date(dobj)
+                date.set_year(date.get_year() -
+                              self.avg_generation_gap * (depth + 1))
+                return (date, date.copy_offset_ymd(self.max_age_prob_alive))
+            return (dobj.copy_offset_ymd(-self.avg_generation_gap),
+                    dobj.copy_offset_ymd(-self.avg_generation_gap +
+                                         self.max_age_prob_alive))
+        return (None, None)
+
+    def _events(self, handles):
+        """
+        The (kind, date) of the events of a list of handles found.
+        """
+        for handle in handles:
+            event = self.events.get(handle)
+            if event:
+                yield event
+
+    def _years(self, first, last):
+        """
+        The (birth, death) dates of two years.
+        """
+        return (Date().copy_ymd(first), Date().copy_ymd(last))
+
+    def _siblings(self, family_handle):
+        """
+        Estimate from the first child of a family with a dated birth or
+        death, or else a dated related event.
+        """
+        family = self.families.get(family_handle)
+        if family is None:
+            return None
+        sib = self.max_sib_age_diff
+        most = self.max_age_prob_alive
+        for child_handle in family[2]:
+            child = self.people.get(child_handle)
+            if child is None:
+                continue
+            # the birth or death events first, then the related ones
+            for (births, deaths) in ((BIRTH, DEATH),
+                                     (BIRTH_FALLBACK, DEATH_FALLBACK)):
+                for (kind, dobj) in self._events(child[2]):
+                    if kind & births:
+                        if dobj.get_start_date() != Date.EMPTY:
+                            year = dobj.get_year()
+                            if year != 0:
+                                return self._years(year - sib,
+                                                   year - sib + most)
+                    elif kind & deaths:
+                        if dobj.get_start_date() != Date.EMPTY:
+                            year = dobj.get_year()
+                            if year != 0:
+                                return self._years(year - sib - most,
+                                                   year - sib)
+        return None
+
+    def _spouses(self, handle, families):
+        """
+        Estimate from the first spouse with evidence, or else the first
+        dated event of a family.
+        """
+        gap = self.avg_generation_gap
+        most = self.max_age_prob_alive
+        for family_handle in families:
+            family = self.families.get(family_handle)
+            if not family:
+                continue
+            (father, mother, children, events) = family
+            spouse = None
+            if mother == handle and father:
+                spouse = father
+            elif father == handle and mother:
+                spouse = mother
+            if spouse is not None:
+                (date1, date2) = self.alive_range(spouse, True)
+                if date1 and date1.get_year() != 0:
+                    return self._years(date1.get_year() - gap,
+                                       date1.get_year() - gap + most)
+                elif date2 and date2.get_year() != 0:
+                    return self._years(date2.get_year() + gap - most,
+                                       date2.get_year() + gap)
+            for (kind, dobj) in self._events(events):
+                year = dobj.get_year()
+                if year != 0:
+                    return self._years(year - gap, year - gap + most)
+        return None
+
+    def _descendants(self, handle):
+        """
+        The first evidence found among the descendants of a person, depth
+        first: (BIRTH or DEATH, date, generations below the children), or
+        None.
+        """
+        if handle in self.descendants:
+            return self.descendants[handle]
+        # a loop in the descendants ends here
+        self.descendants[handle] = None
+        found = self._search_descendants(handle)
+        self.descendants[handle] = found
+        return found
+
+    def _search_descendants(self, handle):
+        for family_handle in self.people[handle][4]:
+            family = self.families.get(family_handle)
+            if not family:
+                continue
+            for child_handle in family[2]:
+                child = self.people.get(child_handle)
+                if child is None:
+                    continue
+                for (ref, kind) in ((child[0], BIRTH), (child[1], DEATH)):
+                    if ref:
+                        event = self.events.get(ref[0])
+                        if (event and
+                                event[1].get_start_date() != Date.EMPTY):
+                            return (kind, event[1], 0)
+                found = self._descendants(child_handle)
+                if found:
+                    return (found[0], found[1], found[2] + 1)
+                for (kind, dobj) in self._events(child[2]):
+                    if kind & BIRTH_FALLBACK:
+                        if dobj.get_start_date() != Date.EMPTY:
+                            return (BIRTH, dobj, 0)
+                    elif kind & DEATH_FALLBACK:
+                        if dobj.get_start_date() != Date.EMPTY:
+                            return (DEATH, dobj, 0)
+        return None
+
+#-------------------------------------------------------------------------
+#
+# BulkLivingProxyDb
+#
+#-------------------------------------------------------------------------
+# Whether LivingProxyDb still decides through its private __is_living,
+# which BulkLivingProxyDb replaces
+BULK_LIVING_SUPPORTED = hasattr(LivingProxyDb, "_LivingProxyDb__is_living")
+
+class BulkLivingProxyDb(LivingProxyDb):
+    """
+    LivingProxyDb deciding who is living from a LivingEngine run once on
+    the whole database it hides the living people of, rather than by a
+    call to probably_alive for each person and family read. As with
+    LivingProxyDb, what the proxies below hide (private events...) is not
+    used as evidence.
+
+    Experimental, as LivingEngine. It overrides the private method of
+    LivingProxyDb, and must only be used when BULK_LIVING_SUPPORTED.
+    """
+    def __init__(self, dbase, mode, current_year=None, years_after_death=0):
+        LivingProxyDb.__init__(self, dbase, mode, current_year,
+                               years_after_death)
+        self.living = LivingEngine(self.db, self.basedb).living(
+            self.current_date, self.years_after_death)
+
+    def _LivingProxyDb__is_living(self, person):
+        """
+        Replaces the private LivingProxyDb.__is_living.
+        """
+        return person.get_handle() in self.living
+
+#-------------------------------------------------------------------------
+#
+# KinshipIndex
+#
+#-------------------------------------------------------------------------
+class KinshipIndex(object):
+    """
+    Parents and children of every person of a tree, read from the raw
+    data of the families in one pass, for the selection of a branch.
+    """
+    def __init__(self, dbase):
+        # family handle -> (father, mother, children)
+        self.families = {}
+        # person handle -> families as a child
+        self.parent_families = {}
+        # person handle -> families as a parent
+        self.own_families = {}
+        with dbase.get_family_cursor() as cursor:
+            for (handle, data) in cursor:
+                handle = _text(handle)
+                children = [ref[3] for ref in data[4]]
+                self.families[handle] = (data[2], data[3], children)
+                for parent in data[2:4]:
+                    if parent:
+                        self.own_families.setdefault(parent, []).append(
+                            handle)
+                for child in children:
+                    self.parent_families.setdefault(child, []).append(handle)
+
+    def branch(self, roots, ancestors=True, descendants=True, generations=0):
+        """
+        Return the handles of the people and of the families of the branch
+        of the roots: their ancestors and/or their descendants with their
+        spouses, up to generations away from them (0 for all). The families
+        are those of the people selected, as FilterProxyDb keeps them.
+        """
+        people = set(roots)
+        if ancestors:
+            people.update(self._walk(roots, generations, self._parents))
+        if descendants:
+            found = self._walk(roots, generations, self._children)
+            people.update(found)
+            for handle in found:
+                for family in self.own_families.get(handle, ()):
+                    (father, mother, children) = self.families[family]
+                    people.update(parent for parent in (father, mother)
+                                  if parent)
+        families = set()
+        for handle in people:
+            families.update(self.parent_families.get(handle, ()))
+            families.update(self.own_families.get(handle, ()))
+        return (people, families)
+
+    def _walk(self, roots, generations, relatives):
+        """
+        Breadth-first search of the people reached from the roots by
+        relatives, up to generations steps (0 for no limit).
+        """
+        seen = set(roots)
+        queue = deque((handle, 0) for handle in roots)
+        while queue:
+            (handle, generation) = queue.popleft()
+            if generations and generation >= generations:
+                continue
+            for relative in relatives(handle):
+                if relative not in seen:
+                    seen.add(relative)
+                    queue.append((relative, generation + 1))
+        return seen
+
+    def _parents(self, handle):
+        """
+        Fathers and mothers of a person.
+        """
+        for family in self.parent_families.get(handle, ()):
+            (father, mother, children) = self.families[family]
+            if father:
+                yield father
+            if mother:
+                yield mother
+
+    def _children(self, handle):
+        """
+        Children of a person.
+        """
+        for family in self.own_families.get(handle, ()):
+            for child in self.families[family][2]:
+                yield child
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+#
+# Gramps - a GTK+/GNOME based genealogy program
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+
+"""
+Micro-benchmark of the CONC line wrapper on multi-kilobyte notes.
+
+Compares libgeneanet.breakup with the character-by-character backward
+scan it replaced, on ASCII, French and Cyrillic notes of a few sizes. The
+old wrapper counts characters, not bytes: it makes fewer, longer chunks
+of the accented notes.
+
+    python3 bench_breakup.py [--sizes BYTES,...] [--repeat N]
+"""
+import argparse
+import os
+import random
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir, "GedcomforGeneanet"))
+from libgeneanet import breakup
+
+
+def legacy_breakup(txt, limit):
+    """
+    The wrapper shipped up to 1.7.1.
+    """
+    data = []
+    while len(txt) > limit:
+        idx = limit
+        while (idx > 0 and (txt[idx - 1].isspace() or txt[idx].isspace() or
+                            ord(txt[idx - 1]) > 127)):
+            idx -= 1
+        if idx == 0:
+            idx = limit
+        data.append(txt[:idx])
+        txt = txt[idx:]
+    if len(txt) > 0:
+        data.append(txt)
+    return data
+
+
+WORDS = {
+    "ascii": "the parish register of saint martin records the baptism of".split(),
+    "french": "été baptisé église paroisse Sébastien Françoise née à Évreux"
+              " témoin curé".split(),
+    "cyrillic": "крещение церковь приход свидетель священник родился".split(),
+}
+
+
+def make_note(words, size):
+    rnd = random.Random(42)
+    parts = []
+    length = 0
+    while length < size:
+        word = rnd.choice(words)
+        parts.append(word)
+        length += len(word) + 1
+    return " ".join(parts)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[1])
+    parser.add_argument("--sizes", default="1024,8192,65536")
+    parser.add_argument("--repeat", type=int, default=2000)
+    parser.add_argument("--limit", type=int, default=72)
+    args = parser.parse_args()
+
+    print("%-10s %6s %12s %12s %8s %10s" % ("note", "size", "legacy (ms)",
+                                            "new (ms)", "ratio", "chunks"))
+    for size in [int(size) for size in args.sizes.split(",")]:
+        # about the same number of bytes wrapped for each size
+        number = max(1, args.repeat * 8192 // size)
+        for name, words in sorted(WORDS.items()):
+            note = make_note(words, size)
+            for chunk in breakup(note, args.limit):
+                assert len(chunk.encode("utf-8")) <= args.limit
+            assert "".join(breakup(note, args.limit)) == note
+            # best of 5, against the noise of a shared machine
+            old = min(timeit.repeat(lambda: legacy_breakup(note, args.limit),
+                                    number=number, repeat=5))
+            new = min(timeit.repeat(lambda: breakup(note, args.limit),
+                                    number=number, repeat=5))
+            print("%-10s %6d %12.3f %12.3f %7.1fx %5d/%-5d" % (
+                name, size, old * 1000 / number, new * 1000 / number,
+                old / new, len(legacy_breakup(note, args.limit)),
+                len(breakup(note, args.limit))))
+
+
+if __name__ == "__main__":
+    main()
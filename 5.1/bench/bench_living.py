@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+#
+# Gramps - a GTK+/GNOME based genealogy program
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+
+"""
+Benchmark of the living people determination.
+
+Compares LivingProxyDb, which calls probably_alive for each person,
+with libgeneanetdb.BulkLivingProxyDb, on a generated SQLite tree seen
+through a PrivateProxyDb as in an export, and checks that both hide the
+same people. A fraction of the events and event references are private,
+and must not be taken as evidence. Needs Gramps on the Python path.
+
+    python3 bench_living.py [--generations N] [--children N] [--dated F]
+                            [--private F]
+"""
+import argparse
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir, "GedcomforGeneanet"))
+from gramps.gen.db import DbTxn
+from gramps.gen.db.utils import make_database
+from gramps.gen.lib import (ChildRef, Date, Event, EventRef, EventType,
+                            Family, Person)
+from gramps.gen.proxy.living import LivingProxyDb
+from gramps.gen.proxy.private import PrivateProxyDb
+from gramps.gen.utils.id import create_id
+from libgeneanetdb import BulkLivingProxyDb
+
+
+def make_tree(dbase, generations, children, dated, private=0.0):
+    """
+    Couples with children over generations, from 1700 on. A fraction
+    dated of the births, deaths and baptisms are dated, with none in the
+    last three generations, so that most people are judged from their
+    relatives. A fraction private of these events, and as many of the
+    references to the others, are private.
+    """
+    rnd = random.Random(7)
+    people = []
+    families = []
+    events = []
+
+    def new_person(gender, year, generation):
+        person = Person()
+        person.set_handle(create_id())
+        person.set_gender(gender)
+        recent = generation >= generations - 3
+        for (etype, offset) in ((EventType.BIRTH, 0), (EventType.BAPTISM, 0),
+                                (EventType.DEATH, 60)):
+            if recent or rnd.random() >= dated:
+                continue
+            event = Event()
+            event.set_handle(create_id())
+            event.set_type(etype)
+            event.set_date_object(Date(year + offset, 1, 1))
+            events.append(event)
+            ref = EventRef()
+            ref.set_reference_handle(event.get_handle())
+            if rnd.random() < private:
+                event.set_privacy(True)
+            elif rnd.random() < private:
+                ref.set_privacy(True)
+            person.add_event_ref(ref)
+            if etype == EventType.BIRTH:
+                person.set_birth_ref(ref)
+            elif etype == EventType.DEATH:
+                person.set_death_ref(ref)
+        people.append(person)
+        return person
+
+    couples = [(new_person(Person.MALE, 1700, 0),
+                new_person(Person.FEMALE, 1700, 0))]
+    for generation in range(1, generations):
+        year = 1700 + 25 * generation
+        next_couples = []
+        for (father, mother) in couples:
+            family = Family()
+            family.set_handle(create_id())
+            family.set_father_handle(father.get_handle())
+            family.set_mother_handle(mother.get_handle())
+            father.add_family_handle(family.get_handle())
+            mother.add_family_handle(family.get_handle())
+            families.append(family)
+            for num in range(children):
+                child = new_person(num % 2 and Person.FEMALE or Person.MALE,
+                                   year, generation)
+                ref = ChildRef()
+                ref.set_reference_handle(child.get_handle())
+                family.add_child_ref(ref)
+                child.add_parent_family_handle(family.get_handle())
+                if num < 2:
+                    spouse = new_person(
+                        num % 2 and Person.MALE or Person.FEMALE, year,
+                        generation)
+                    next_couples.append(
+                        (spouse, child) if num % 2 else (child, spouse))
+        couples = next_couples
+
+    with DbTxn("bench", dbase) as trans:
+        for event in events:
+            dbase.add_event(event, trans)
+        for person in people:
+            dbase.add_person(person, trans)
+        for family in families:
+            dbase.add_family(family, trans)
+    return len(people)
+
+
+def visible(proxy):
+    """
+    Return the time to list the people of proxy, and their handles.
+    """
+    start = time.time()
+    handles = set(person.get_handle() for person in proxy.iter_people())
+    return (time.time() - start, handles)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[1])
+    parser.add_argument("--generations", type=int, default=12)
+    parser.add_argument("--children", type=int, default=4)
+    parser.add_argument("--dated", type=float, default=0.3)
+    parser.add_argument("--private", type=float, default=0.2)
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix="bench_living")
+    dbase = make_database("sqlite")
+    try:
+        dbase.load(directory)
+        count = make_tree(dbase, args.generations, args.children, args.dated,
+                          args.private)
+        private = PrivateProxyDb(dbase)
+
+        (reference, expected) = visible(
+            LivingProxyDb(private, LivingProxyDb.MODE_EXCLUDE_ALL))
+        print("%-24s %8.2fs %8d people, %d not living" % (
+            "LivingProxyDb", reference, count, len(expected)))
+
+        # the engine runs when the proxy is made
+        start = time.time()
+        (_listed, shown) = visible(
+            BulkLivingProxyDb(private, LivingProxyDb.MODE_EXCLUDE_ALL))
+        elapsed = time.time() - start
+        print("%-24s %8.2fs %8s x%.1f" % ("BulkLivingProxyDb", elapsed, "",
+                                         reference / max(elapsed, 1e-6)))
+        if shown != expected:
+            print("different: %d more, %d less" % (len(shown - expected),
+                                                 len(expected - shown)))
+            return 1
+        return 0
+    finally:
+        dbase.close()
+        shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+#
+# Gramps - a GTK+/GNOME based genealogy program
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+
+"""
+Benchmark of the media zip stage.
+
+Compares the serial ZipFile.write loop of the original export, which
+stores the files, with libgeneanet.MediaArchive for several worker
+counts, on generated scans. --level deflates the files in both.
+
+    python3 bench_zip.py [--files N] [--size BYTES] [--level 0-9]
+                         [--workers 1,2,4,8]
+"""
+import argparse
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import zipfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir, "GedcomforGeneanet"))
+from libgeneanet import MediaArchive
+
+
+def make_media(directory, count, size):
+    """
+    Half of the files compress well (uncompressed scans), half do not.
+    """
+    rnd = random.Random(7)
+    paths = []
+    for num in range(count):
+        path = os.path.join(directory, "scan%05d.bmp" % num)
+        with open(path, "wb") as fileobj:
+            if num % 2:
+                fileobj.write(os.urandom(size))
+            else:
+                line = bytes(rnd.randrange(256) for _ in range(512))
+                fileobj.write(line * (size // len(line)))
+        paths.append(path)
+    return paths
+
+
+def serial(paths, target, level):
+    if level:
+        archive = zipfile.ZipFile(target, "w", zipfile.ZIP_DEFLATED,
+                                  compresslevel=level)
+    else:
+        archive = zipfile.ZipFile(target, "w")
+    for path in paths:
+        archive.write(path, os.path.basename(path))
+    archive.close()
+
+
+def parallel(paths, target, level, workers):
+    archive = MediaArchive(target, workers=workers,
+                           compresslevel=level or None)
+    for path in paths:
+        archive.add(path, os.path.basename(path))
+    archive.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[1])
+    parser.add_argument("--files", type=int, default=200)
+    parser.add_argument("--size", type=int, default=1 << 20)
+    parser.add_argument("--level", type=int, default=0,
+                        help="deflate level, 0 stores as the export does")
+    parser.add_argument("--workers", default="1,2,4,%d" % (os.cpu_count() or 1))
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix="bench_zip")
+    try:
+        paths = make_media(directory, args.files, args.size)
+        target = os.path.join(directory, "media.zip")
+        start = time.time()
+        serial(paths, target, args.level)
+        reference = time.time() - start
+        print("%-18s %8.2fs %10d bytes" % ("serial ZipFile", reference,
+                                          os.path.getsize(target)))
+        for workers in [int(num) for num in args.workers.split(",")]:
+            start = time.time()
+            parallel(paths, target, args.level, workers)
+            elapsed = time.time() - start
+            assert zipfile.ZipFile(target).testzip() is None
+            print("%-18s %8.2fs %10d bytes %6.1fx" % (
+                "%d worker(s)" % workers, elapsed, os.path.getsize(target),
+                reference / elapsed))
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    main()